@@ -37,76 +37,49 @@ fmt = "png" #"pdf"
 import pandas as pd
 import datetime
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from shutil import copyfile
 from collections import defaultdict
-from matplotlib.patches import Rectangle
 import json
+import os
 from colors_and_countries import *
 from travel_data import *
 from helpers import *
 from paths import *
 from clusters import *
 from bad_sequences import *
+from count_cube import CountCube, get_division_summaries
+from incremental_series import load_cluster_json, stored_since, update_cluster_series
+from streaming_frequencies import StreamingFrequencies
+from trend_plots import trend_series, trend_job, render_trend_figure
+from render_pool import render_all
+from artifact_store import record
+from output_writer import OutputWriter
+from nowcast import save_snapshot, load_snapshots, align_snapshots, estimate_completeness
 
 def get_division_summary(cluster_meta, chosen_country):
+    # For all countries and clusters at once, use `get_division_summaries` directly
+    division_info = get_division_summaries(cluster_meta[cluster_meta['country'] == chosen_country],
+                                           {chosen_country: cluster_meta['strain']})
+    division_info_df = division_info.drop_duplicates('division').set_index('division')
 
-    country_meta = cluster_meta[cluster_meta['country'].apply(lambda x: x == chosen_country)]
-    observed_divisions = [x for x in country_meta['division'].unique()]
-
-    division_info = pd.DataFrame(index=observed_divisions, columns=['first_seq', 'num_seqs', 'last_seq'])
-    division_dates = {}
-    
-    for div in observed_divisions:
-        temp_meta = cluster_meta[cluster_meta['division'].apply(lambda x: x == div)]
-        division_info.loc[div].first_seq = temp_meta['date'].min()
-        division_info.loc[div].last_seq = temp_meta['date'].max()
-        division_info.loc[div].num_seqs = len(temp_meta)
-        division_dates[div] = [datetime.datetime.strptime(dat, '%Y-%m-%d') for dat in temp_meta['date']]
-
-    division_info_df = pd.DataFrame(data=division_info)
-
-    print("\nOrdered list by first_seq date:")
-    print(division_info_df.sort_values(by="first_seq"))
-
+    return division_info_df.loc[:, ['first_seq', 'num_seqs', 'last_seq']].sort_values(by="first_seq")
 
 
 def get_summary(cluster_meta, observed_countries):
-
+    # Only the cheap per-country numbers (first, last, count) - these decide what gets
+    # plotted, so the weekly series are built later and only for countries that make the cut.
     country_info = pd.DataFrame(index=observed_countries, columns=['first_seq', 'num_seqs', 'last_seq'])
-    country_dates = {}
-
-    for coun in observed_countries:
-        if coun in uk_countries:
-            #temp_meta = cluster_meta[cluster_meta['division'].isin([coun])]
-            temp_meta = cluster_meta[cluster_meta['division'].apply(lambda x: x == coun)]
-        else:
-            #temp_meta = cluster_meta[cluster_meta['country'].isin([coun])]
-            temp_meta = cluster_meta[cluster_meta['country'].apply(lambda x: x == coun)]
-
-        country_info.loc[coun].first_seq = temp_meta['date'].min()
-        country_info.loc[coun].last_seq = temp_meta['date'].max()
-        country_info.loc[coun].num_seqs = len(temp_meta)
 
-        country_dates[coun] = [datetime.datetime.strptime(dat, '%Y-%m-%d') for dat in temp_meta['date']]
+    for col, countries in [('division', [x for x in observed_countries if x in uk_countries]),
+                           ('country', [x for x in observed_countries if x not in uk_countries])]:
+        if not countries:
+            continue
+        temp_meta = cluster_meta[cluster_meta[col].isin(countries)]
+        summary = temp_meta.groupby(col)['date'].agg(['min', 'max', 'size'])
+        country_info.loc[summary.index, 'first_seq'] = summary['min']
+        country_info.loc[summary.index, 'last_seq'] = summary['max']
+        country_info.loc[summary.index, 'num_seqs'] = summary['size']
 
-    return country_info, country_dates
-
-
-def marker_size(n):
-    if n>100:
-        return 150
-    elif n>30:
-        return 100
-    elif n>10:
-        return 70
-    elif n>3:
-        return 50
-    elif n>1:
-        return 20
-    else:
-        return 5
+    return country_info
 
 
 ##################################
@@ -139,12 +112,30 @@ if print_answer in ["y", "Y", "yes", "YES", "Yes"]:
 print_files2 = True
 print(f"Writing out files? {print_files}")
 
+# Data-only mode: write the JSON/TSV outputs but no figures, so matplotlib is never imported
+data_only = False
+if print_files:
+    data_only_answer = input("\nOnly write data (JSON/TSV), no figures?(y/n) (Enter is no): ")
+    if data_only_answer in ["y", "Y", "yes", "YES", "Yes"]:
+        data_only = True
+    print(f"Data only? {data_only}")
+
 print_acks = False
 print_ack_answer = input("\nWrite out acknowledgements?(y/n) (Enter is no): ")
 if print_ack_answer in ["y", "Y", "yes", "YES", "Yes"]:
     print_acks = True
 print(f"Writing out acknowledgements? {print_acks}")
 
+# Incremental mode: only merge the last few weeks into the existing *_data.json
+# and re-smooth the tail, instead of rewriting the whole series.
+update_json = False
+update_json_answer = input("\nOnly update latest weeks in existing *_data.json?(y/n) (Enter is no): ")
+if update_json_answer in ["y", "Y", "yes", "YES", "Yes"]:
+    update_json = True
+print(f"Updating *_data.json incrementally? {update_json}")
+# how many weeks before the last stored week counts are still expected to change (late submissions)
+revision_weeks = 4
+
 #default is 222, but ask user what they want - or run all.
 clus_to_run = ["S222"]
 reask = True
@@ -177,12 +168,16 @@ print("These clusters will be run: ", clus_to_run)
 
 json_output = {}
 
+# Files are written on a background thread while the pipeline goes on (see output_writer.py);
+# everything is flushed at the end, where any write that failed raises.
+writer = OutputWriter()
+
 # if running all clusters, clear file so can write again.
 if print_files and "all" in clus_answer:
     #clean these files so don't append to last run.
-    with open(f"{tables_path}all_tables.md", 'w') as fh:
-        fh.write('\n')
-        fh.write("# Overview of Clusters/Mutations in Europe\n"	
+    writer.write(f"{tables_path}all_tables.md",
+        '\n'
+        "# Overview of Clusters/Mutations in Europe\n"	
         "[Overview of proportion of clusters in selected countries](country_overview.md)\n\n"
         "In the graphs below, countries are displayed in the chart if the country has at least 20 sequences present in the cluster.\n\n"
         "# Mutation Tables and Graphs\n"
@@ -198,8 +193,7 @@ if print_files and "all" in clus_answer:
         "- [S:D80Y](#sd80y) \n"
         "- [S:A626S](#sa626s) \n"
         "- [S:V1122L](#sv1122l) \n\n")
-    with open(overall_tables_file, 'w') as fh:
-        fh.write('\n')
+    writer.write(overall_tables_file, '\n')
 
 
 ######################################################################################################
@@ -323,9 +317,7 @@ for clus in clus_to_run:
     # Write out a file of the names of those 'in the cluster' - this is used by ncov_cluster
     # to make a ncov run where the 'focal' set is this cluster.
     if print_files:
-        with open(clusterlist_output, 'w') as f:
-            for item in wanted_seqs:
-                f.write("%s\n" % item)
+        writer.write(clusterlist_output, "".join("%s\n" % item for item in wanted_seqs))
 
         # Copy file with date, so we can compare to prev dates if we want...
         if clus in clusters:
@@ -333,10 +325,10 @@ for clus in clus_to_run:
         else:
             build_nam = "mink"
         copypath = clusterlist_output.replace(f"{build_nam}", "{}-{}".format(build_nam, datetime.date.today().strftime("%Y-%m-%d")))
-        copyfile(clusterlist_output, copypath)
+        writer.call(clusterlist_output, record, clusterlist_output, copypath)
 
         # Just so we have the data, write out the metadata for these sequences
-        cluster_meta.to_csv(out_meta_file,sep="\t",index=False)
+        writer.call(out_meta_file, cluster_meta.to_csv, out_meta_file, sep="\t", index=False)
 
     # What countries do sequences in the cluster come from?
     observed_countries = [x for x in cluster_meta['country'].unique()]
@@ -350,11 +342,10 @@ for clus in clus_to_run:
         print([x for x in observed_countries if x not in country_list])
 
     # Let's get some summary stats on number of sequences, first, and last, for each country.
-    country_info, country_dates = get_summary(cluster_meta, observed_countries)
+    country_info = get_summary(cluster_meta, observed_countries)
     print(country_info)
     print("\n")
     clus_data['country_info'] = country_info
-    clus_data['country_dates'] = country_dates
 
     # make into a dataframe for sorting
     country_info_df = pd.DataFrame(data=country_info)
@@ -374,13 +365,11 @@ for clus in clus_to_run:
         noUK_out_meta_file = cluster_path+f'/cluster_info/cluster_{clusters[clus]["build_name"]}-noUK_meta.tsv'
 
         if print_files:
-            with open(noUK_clusterlist_output, 'w') as f:
-                for item in extra501_wanted_seqs:
-                    f.write("%s\n" % item)
+            writer.write(noUK_clusterlist_output, "".join("%s\n" % item for item in extra501_wanted_seqs))
             build_nam = clusters[clus]["build_name"]
             copypath = noUK_clusterlist_output.replace(f"{build_nam}-noUK", "{}-noUK-{}".format(build_nam, datetime.date.today().strftime("%Y-%m-%d")))
-            copyfile(noUK_clusterlist_output, copypath)
-            nouk_501_meta.to_csv(noUK_out_meta_file,sep="\t",index=False)
+            writer.call(noUK_clusterlist_output, record, noUK_clusterlist_output, copypath)
+            writer.call(noUK_out_meta_file, nouk_501_meta.to_csv, noUK_out_meta_file, sep="\t", index=False)
 
     #######
     #print out the table
@@ -389,12 +378,11 @@ for clus in clus_to_run:
     clus_data['country_info_ordered'] = ordered_country
 
     if print_files:
-        ordered_country.to_csv(table_file, sep="\t")
+        writer.write(table_file, ordered_country.to_csv(sep="\t"))
         #only write if doing all clusters
         if "all" in clus_answer:
-            with open(overall_tables_file, 'a') as fh:
-                fh.write(f'\n\n## {clus_display}\n')
-            ordered_country.to_csv(overall_tables_file, sep="\t", mode='a')
+            writer.append(overall_tables_file, f'\n\n## {clus_display}\n')
+            writer.append(overall_tables_file, ordered_country.to_csv(sep="\t"))
         mrk_tbl = ordered_country.to_markdown()
 
         #url_params = "f_region=Europe"
@@ -409,118 +397,25 @@ for clus in clus_to_run:
 
         # don't print DanishCluster in 'all tables'
         # only print 'all tables' if running 'all clusters'
-        if "all" in clus_answer and clus != "DanishCluster":
-            with open(f"{tables_path}all_tables.md", 'a') as fh:
-                fh.write(f'\n\n## {clus_display}\n')
-                fh.write(f"[Focal Build]({nextstrain_url})\n\n")
-                if clus == "S477":
-                    fh.write(f"Note any pre-2020 Cambodian sequences are from SARS-like viruses in bats (not SARS-CoV-2).\n")
-                if clus == "S501":
-                    fh.write(f"Note any pre-2020 Chinese sequences are from SARS-like viruses in bats (not SARS-CoV-2).\n")
-                    fh.write(f"Note that this mutation has multiple amino-acid mutants - these numbers "
-                            "refer to _all_ these mutations (Y, S, T).\n")
-                fh.write(mrk_tbl)
-                fh.write("\n\n")
-                fh.write(f"![Overall trends {clus_display}](/overall_trends_figures/overall_trends_{clus_display}.png)")
-
-        with open(f"{tables_path}{clus_display}_table.md", 'w') as fh:
-            fh.write(f'\n\n## {clus_display}\n')
-            fh.write(f"[Focal Build]({nextstrain_url})\n\n")
-            if clus == "S477":
-                fh.write(f"Note any pre-2020 Cambodian sequences are from SARS-like viruses in bats (not SARS-CoV-2).\n")
-            if clus == "S501":
-                fh.write(f"Note any pre-2020 Chinese sequences are from SARS-like viruses in bats (not SARS-CoV-2).\n")
-                fh.write(f"Note that this mutation has multiple amino-acid mutants - these numbers "
-                          "refer to _all_ these mutations (Y, S, T).\n")
-            fh.write(mrk_tbl)
-            fh.write("\n\n")
-            fh.write(f"![Overall trends {clus_display}](/overall_trends_figures/overall_trends_{clus_display}.png)")
-
-
-
-
-######################################################################################################
-##################################
-#### PREPARING FOR OF PLOTTING
-
-for clus in clus_to_run:
-    print(f"\nPreparing to plot cluster {clus}\n")
-
-    clus_data = clusters[clus]
-    wanted_seqs = clus_data['wanted_seqs']
-    clus_display = clus_data['build_name']
-    cluster_meta = clus_data['cluster_meta']
-    observed_countries = clus_data['observed_countries']
-    country_dates = clus_data['country_dates']
-    country_info_df = clus_data['country_info_ordered']
-
-    clus_data['cluster_data'] = []
-    clus_data['total_data'] = []
-
-    # We want to look at % of samples from a country that are in this cluster
-    # To avoid the up-and-down of dates, bin samples into weeks
-    countries_to_plot = country_list
-    acknowledgement_table = []
-    clus_data['acknowledgements'] = acknowledgement_table
-
-    # Get counts per week for sequences in the cluster
-    clus_week_counts = {}
-    for coun in observed_countries:
-        counts_by_week = defaultdict(int)
-        for dat in country_dates[coun]:
-            #counts_by_week[dat.timetuple().tm_yday//7]+=1 # old method
-            #counts_by_week[dat.isocalendar()[1]]+=1  #returns ISO calendar week
-            wk = dat.isocalendar()[1]#returns ISO calendar week
-            yr = dat.isocalendar()[0]
-            yr_wk = (yr, wk)
-            counts_by_week[yr_wk]+=1
-        clus_week_counts[coun] = counts_by_week
-
-    # Get counts per week for sequences regardless of whether in the cluster or not - from week 20 only.
-    total_week_counts = {}
-    for coun in observed_countries:
-        counts_by_week = defaultdict(int)
-        if coun in uk_countries:
-            #temp_meta = meta[meta['division'].isin([coun])]
-            temp_meta = meta[meta['division'].apply(lambda x: x == coun)]
-        else:
-            #temp_meta = meta[meta['country'].isin([coun])]
-            temp_meta = meta[meta['country'].apply(lambda x: x == coun)]
-
-        temp_meta = temp_meta[temp_meta['date'].apply(lambda x: len(x) == 10)]
-        temp_meta = temp_meta[temp_meta['date'].apply(lambda x: 'XX' not in x)]
-
-        temp_meta['date_formatted'] = temp_meta['date'].apply(lambda x:datetime.datetime.strptime(x, "%Y-%m-%d"))
-        #temp_meta['calendar_week'] = temp_meta['date_formatted'].apply(lambda x: x.isocalendar()[1])
-        temp_meta['calendar_week'] = temp_meta['date_formatted'].apply(lambda x: (x.isocalendar()[0], x.isocalendar()[1]))
-        temp_meta = temp_meta[temp_meta['calendar_week']>=(2020,20)]
-
-        #date_list = temp_meta['date'].apply(lambda x:datetime.datetime.strptime(x, "%Y-%m-%d"))
-        #week_list = date_list.apply(lambda x: x.isocalendar()[1])
-        #week_list_20 = week_list[week_list.apply(lambda x: x >=20 )]
-
-        week_counts = temp_meta['calendar_week'].value_counts().sort_index()
-        counts_by_week = week_counts.to_dict()
+        md_text = f'\n\n## {clus_display}\n'
+        md_text += f"[Focal Build]({nextstrain_url})\n\n"
+        if clus == "S477":
+            md_text += f"Note any pre-2020 Cambodian sequences are from SARS-like viruses in bats (not SARS-CoV-2).\n"
+        if clus == "S501":
+            md_text += f"Note any pre-2020 Chinese sequences are from SARS-like viruses in bats (not SARS-CoV-2).\n"
+            md_text += (f"Note that this mutation has multiple amino-acid mutants - these numbers "
+                        "refer to _all_ these mutations (Y, S, T).\n")
+        md_text += mrk_tbl
+        md_text += "\n\n"
+        md_text += f"![Overall trends {clus_display}](/overall_trends_figures/overall_trends_{clus_display}.png)"
 
-        total_week_counts[coun] = counts_by_week
+        if "all" in clus_answer and clus != "DanishCluster":
+            writer.append(f"{tables_path}all_tables.md", md_text)
 
-        if print_acks:
-            acknowledgement_table = temp_meta.loc[:,['strain', 'gisaid_epi_isl', 'originating_lab', 'submitting_lab', 'authors']]
+        writer.write(f"{tables_path}{clus_display}_table.md", md_text)
 
-        
-    if print_acks:
-        acknowledgement_table.to_csv(f'{acknowledgement_folder}{clus}_acknowledgement_table.tsv', sep="\t")
 
 
-    # Convert into dataframe
-    cluster_data = pd.DataFrame(data=clus_week_counts)
-    total_data = pd.DataFrame(data=total_week_counts)
-    clus_data['cluster_data'] = cluster_data
-    clus_data['total_data'] = total_data
-    # sort
-    total_data=total_data.sort_index()
-    cluster_data=cluster_data.sort_index()
-
 
 ######################################################################################################
 ##################################
@@ -565,12 +460,74 @@ countries_to_plot_final = all_num_seqs[all_num_seqs.has_20 == "*"].index
 
 
 
+######################################################################################################
+##################################
+#### PREPARING FOR OF PLOTTING
+# Weekly series are only built for countries that end up in the JSON or the plot
+# (more than `min_to_plot` sequences in the cluster); everything else is skipped.
+
+# Only plot countries with >= X seqs
+min_to_plot = 30
+#if clus == "S222":
+#    min_to_plot = 200
+
+# All weekly counts come from one cube, built in a single pass over the metadata (see count_cube.py):
+# every cluster and all sequences per division, from week 20 on, rolled up to countries. The UK
+# nations are rows of their own via `country_overrides`, so they need no separate handling.
+cube = CountCube.from_metadata(meta, {clus: list(clusters[clus]['cluster_meta']['strain']) for clus in clus_to_run},
+                               min_week=(2020,20))
+all_total_data = cube.total_data()
+series_built = 0
+series_skipped = 0
+
+for clus in clus_to_run:
+    print(f"\nPreparing to plot cluster {clus}\n")
+
+    clus_data = clusters[clus]
+    wanted_seqs = clus_data['wanted_seqs']
+    clus_display = clus_data['build_name']
+    cluster_meta = clus_data['cluster_meta']
+    observed_countries = clus_data['observed_countries']
+    country_info_df = clus_data['country_info_ordered']
+
+    countries_to_plot_min = country_info_df[country_info_df.num_seqs > min_to_plot].index
+    clus_data['countries_to_plot_min'] = countries_to_plot_min
+    series_built += len(countries_to_plot_min)
+    series_skipped += len(observed_countries) - len(countries_to_plot_min)
+
+    if print_acks:
+        acknowledgement_table = cluster_meta.loc[:,['strain', 'gisaid_epi_isl', 'originating_lab', 'submitting_lab', 'authors']]
+        ack_file = f'{acknowledgement_folder}{clus}_acknowledgement_table.tsv'
+        writer.call(ack_file, acknowledgement_table.to_csv, ack_file, sep="\t")
+
+print(f"Built weekly series for {series_built} cluster/country pairs, "
+      f"skipped {series_skipped} below {min_to_plot} sequences; "
+      f"from a count cube of {len(cube.geography)} divisions and {len(cube.weeks)} weeks.\n")
+
+## Nowcast the latest weeks: every run keeps a snapshot of the total counts, and comparing
+## snapshots tells how complete a week is after a given delay. Once that gives a completeness
+## estimate, the last data point of a series is kept and nowcast; until then it is trimmed as before.
+snapshot_path = tables_path+'count_snapshots/'
+if print_files:
+    # the total counts of all countries, so every snapshot covers the same geographies
+    save_snapshot(all_total_data, snapshot_path)
+completeness = None
+snapshots = load_snapshots(snapshot_path)
+if len(snapshots) > 1:
+    snapshot_dates, snapshot_weeks, _, snapshot_counts = align_snapshots(snapshots)
+    completeness = estimate_completeness(snapshot_dates, snapshot_weeks, snapshot_counts)
+if completeness is not None:
+    print(f"Completeness of the latest weeks from {len(snapshots)} snapshots: {np.round(completeness, 2)}\n")
+
+
+
 ######################################################################################################
 ##################################
 #### BEGINNING OF PLOTTING
 
 
 countries_plotted = {}
+trend_jobs = []
 
 for clus in clus_to_run:
 
@@ -581,24 +538,15 @@ for clus in clus_to_run:
     clus_display = clus_data['build_name']
     cluster_meta = clus_data['cluster_meta']
     observed_countries = clus_data['observed_countries']
-    country_dates = clus_data['country_dates']
     country_info_df = clus_data['country_info_ordered']
-    cluster_data =  clus_data['cluster_data']
-    total_data = clus_data['total_data'] 
 
+    # the same Gaussian kernel as the incremental update of *_data.json (incremental_series.py)
     width = 1
-    smoothing = np.exp(-np.arange(-10,10)**2/2/width**2)
-    smoothing /= smoothing.sum()
-
+    kernel = gaussian_kernel(width)
 
-    # Only plot countries with >= X seqs
-    min_to_plot = 30
-    #if clus == "S222":
-    #    min_to_plot = 200
-
-    countries_to_plot_min = country_info_df[country_info_df.num_seqs > min_to_plot].index
+    countries_to_plot_min = clus_data['countries_to_plot_min']
     
-    countries_to_plot = [x for x in country_info_df[country_info_df.num_seqs > min_to_plot].index if x in countries_to_plot_final]
+    countries_to_plot = [x for x in countries_to_plot_min if x in countries_to_plot_final]
 
 
     if len(countries_to_plot_min) > len(colors):
@@ -615,117 +563,68 @@ for clus in clus_to_run:
             else:
                 country_styles_custom[x] = country_styles[unused_countries.pop(0)]
 
-    # Make a plot
-    repeat = 1
-    if clus == "S222":
-        repeat = 2
-
-    while repeat > 0:
-
-        #fig = plt.figure(figsize=(10,5))
-        #fig, axs=plt.subplots(1,1, figsize=(10,5))
-        fs = 14
-        #fig, (ax1, ax2, ax3) = plt.subplots(nrows=3, sharex=True,figsize=(10,7),
-        #                                    gridspec_kw={'height_ratios':[1,1,3]})
-        # Change to just show Travel to spain only. see above for old 3 panel version
-        if repeat == 2:
-            fig, (ax1, ax3) = plt.subplots(nrows=2, sharex=True,figsize=(10,6),
-                                                gridspec_kw={'height_ratios':[1, 3]})
-        else:
-            fig, ax3 = plt.subplots(1, 1, figsize=(10,5),dpi=72)
-
-        if repeat == 2:
-            i=0
-            for coun in travel_order:
-                if coun in q_free_to_spain:
-                    q_times = q_free_to_spain[coun]
-                    strt = datetime.datetime.strptime(q_times["start"], "%Y-%m-%d")
-                    end = datetime.datetime.strptime(q_times["end"], "%Y-%m-%d")
-                    y_start = i*0.022
-                    height = 0.02
-                    ax1.add_patch(Rectangle((strt,y_start), end-strt, height,
-                                ec=country_styles_custom[coun]['c'], fc=country_styles_custom[coun]['c']))
-
-                    ax1.text(strt, y_start+0.003, q_times["msg"], fontsize=fs*0.8)
-                    if coun == "Denmark":
-                        strt = datetime.datetime.strptime(q_free_to_spain["Denmark2"]["start"], "%Y-%m-%d")
-                        end = datetime.datetime.strptime(q_free_to_spain["Denmark2"]["end"], "%Y-%m-%d")
-                        ax1.add_patch(Rectangle((strt,y_start), end-strt, height,
-                                ec=country_styles_custom[coun]['c'], fc="none", hatch="/"))
-                        ax1.text(strt, y_start+0.003, q_free_to_spain["Denmark2"]["msg"], fontsize=fs*0.8)
-                i=i+1
-            ax1.set_ylim([0,y_start+height])
-            ax1.text(datetime.datetime.strptime("2020-05-03", "%Y-%m-%d"), y_start,
-                    "Quarantine-free", fontsize=fs)
-            ax1.text(datetime.datetime.strptime("2020-05-03", "%Y-%m-%d"), y_start-height-0.005,
-                    "Travel to/from Spain", fontsize=fs)
-            ax1.text(datetime.datetime.strptime("2020-05-03", "%Y-%m-%d"), y_start-height-height-0.01,
-                    "(on return)", fontsize=fs)
-            ax1.get_yaxis().set_visible(False)
-
-        #for a simpler plot of most interesting countries use this:
-        for coun in [x for x in countries_to_plot_min]:
-            week_as_date, cluster_count, total_count, unsmoothed_cluster_count, unsmoothed_total_count = non_zero_counts(cluster_data, total_data, coun, smoothing=smoothing)
-            # remove last data point if that point as less than frac sequences compared to the previous count
-            week_as_date, cluster_count, total_count  = trim_last_data_point(week_as_date, cluster_count, total_count, frac=0.1, keep_count=10)
-            if len(cluster_count) < len(unsmoothed_cluster_count): #if the trim_last_data_point came true, match trimming
-                unsmoothed_cluster_count = unsmoothed_cluster_count[:-1]
-                unsmoothed_total_count = unsmoothed_total_count[:-1]
-
-            json_output[clus_display][coun] = {}
-            json_output[clus_display][coun]["week"] = [datetime.datetime.strftime(x, "%Y-%m-%d") for x in week_as_date]
-            json_output[clus_display][coun]["total_sequences"] = [int(x) for x in total_count]
-            json_output[clus_display][coun]["cluster_sequences"] = [int(x) for x in cluster_count] 
-            json_output[clus_display][coun]["unsmoothed_cluster_sequences"] = [int(x) for x in unsmoothed_cluster_count]
-            json_output[clus_display][coun]["unsmoothed_total_sequences"] = [int(x) for x in unsmoothed_total_count]
-
-            countries_plotted[coun] = "False"
-
-            if coun in countries_to_plot:
-                ax3.plot(week_as_date, cluster_count/total_count,
-                        color=country_styles_custom[coun]['c'],
-                        linestyle=country_styles_custom[coun]['ls'], label=coun)
-                ax3.scatter(week_as_date, cluster_count/total_count, s=[marker_size(n) for n in unsmoothed_total_count],
-                        color=country_styles_custom[coun]['c'],
-                        linestyle=country_styles_custom[coun]['ls'])#
-                countries_plotted[coun] = "True"
-
-        for ni,n in enumerate([0,1,3,10,30,100]):
-            ax3.scatter([week_as_date[0]], [0.08+ni*0.07], s=marker_size(n+0.1), edgecolor='k', facecolor='w')
-            ax3.text(week_as_date[1], 0.06+ni*0.07, f"n>{n}" if n else "n=1")
-            #          color=country_styles[coun]['c'], linestyle=country_styles[coun]['ls'], label=coun)
-
-
-        ax3.text(datetime.datetime(2020,10,1), 0.9, f'{clus_display}', fontsize=fs)
-        plt.legend(ncol=1, fontsize=fs*0.8, loc=2)
-        fig.autofmt_xdate(rotation=30)
-        ax3.tick_params(labelsize=fs*0.8)
-        ax3.set_ylabel('frequency', fontsize=fs)
-        max_date = country_info_df['last_seq'].max()
-        ax3.set_ylim(0,1)
-        ax3.set_xlim(datetime.datetime(2020,5,1), datetime.datetime.strptime(max_date, "%Y-%m-%d"))
-        plt.show()
-        plt.tight_layout()
-
-        #spain opens borders
-        if clus == "S222":
-            ax3.text(datetime.datetime.strptime("2020-06-21", "%Y-%m-%d"), 0.05,
-                    "Spain opens borders", rotation='vertical', fontsize=fs*0.8)
-
-        travel = ''
-        if repeat == 2:
-            travel = 'Travel'
-        if print_files:
-            plt.savefig(figure_path+f"overall_trends_{clus_display}{travel}.{fmt}")
-            trends_path = figure_path+f"overall_trends_{clus_display}{travel}.{fmt}"
-            copypath = trends_path.replace(f"trends_{clus_display}{travel}", "trends-{}".format(datetime.date.today().strftime("%Y-%m-%d")))
-            copyfile(trends_path, copypath)
-        
-        repeat = repeat-1
-
-        if print_files:
-            with open(tables_path+f'{clus_display}_data.json', 'w') as fh:
-                json.dump(json_output[clus_display], fh)
+    # Weekly (cluster, total) counts of the countries to plot, merged into the series of *_data.json
+    # (without a completeness estimate, this also removes the last data point if it has less
+    # than frac sequences compared to the previous one). In update mode, only the weeks that can
+    # have changed since the stored file are taken from the cube and merged into it; otherwise
+    # the series are built like an incremental update of empty entries, so both modes write the same file.
+    json_file = tables_path+f'{clus_display}_data.json'
+    if print_files and update_json:
+        json_output[clus_display] = load_cluster_json(json_file)
+        since = {coun: stored_since(json_output[clus_display].get(coun), revision_weeks) for coun in countries_to_plot_min}
+        stored = [x for x in since.values() if x is not None]
+        recent_counts = cube.week_counts(clus, since=min(stored)) if stored else {}
+        all_counts = cube.week_counts(clus) if len(stored) < len(since) else {}
+        country_counts = {coun: (all_counts if since[coun] is None else recent_counts).get(coun, {})
+                          for coun in countries_to_plot_min}
+    else:
+        all_counts = cube.week_counts(clus)
+        country_counts = {coun: all_counts.get(coun, {}) for coun in countries_to_plot_min}
+    # *_data.json keeps the observed counts; the nowcast of the latest weeks goes in fields of its own
+    n_changed = update_cluster_series(json_output[clus_display], country_counts, kernel,
+                                      datetime.date.today(), completeness)
+
+    # Series of all countries; the figures themselves are rendered below, all at once
+    series = []
+    for coun in countries_to_plot_min:
+        country_json = json_output[clus_display].get(coun, {})
+        week_as_date = [datetime.datetime.strptime(x, "%Y-%m-%d") for x in country_json.get("week", [])]
+
+        countries_plotted[coun] = "False"
+
+        if coun in countries_to_plot and week_as_date:
+            # the plots use the nowcast counts if there are any; weeks still mostly missing get open markers
+            series.append(trend_series(coun, week_as_date,
+                                       country_json.get("nowcast_cluster_sequences", country_json["cluster_sequences"]),
+                                       country_json.get("nowcast_total_sequences", country_json["total_sequences"]),
+                                       country_json["unsmoothed_total_sequences"], country_styles_custom[coun],
+                                       uncertain=country_json.get("uncertain")))
+            countries_plotted[coun] = "True"
+
+    # S222 also gets a version with the quarantine-free travel to/from Spain panel
+    max_date = country_info_df['last_seq'].max()
+    for travel in (['Travel', ''] if clus == "S222" else ['']):
+        travel_panel = None
+        if travel:
+            travel_panel = {'order': travel_order, 'q_free': q_free_to_spain,
+                            'colors': {coun: country_styles_custom[coun]['c'] for coun in travel_order if coun in q_free_to_spain}}
+        trend_jobs.append(trend_job(figure_path+f"overall_trends_{clus_display}{travel}.{fmt}", clus_display, series,
+                                    week_as_date[:2], max_date, travel=travel_panel, spain_opens=(clus == "S222")))
+
+    if print_files and update_json:
+        print(f"Updated {n_changed} entries in {clus_display}_data.json")
+    # in update mode, the file is only rewritten if something changed
+    if print_files and (n_changed or not update_json):
+        writer.write(json_file, json.dumps(json_output[clus_display]))
+
+## Render all overall trends figures at once: headless, in parallel worker processes,
+## skipping those whose data, style and plotting code didn't change
+if print_files and not data_only:
+    # the workers are forked; let the writer go idle first, so none of them copies a lock it holds
+    writer.flush()
+    for trends_path in render_all(render_trend_figure, trend_jobs):
+        copypath = figure_path+"overall_trends-{}.{}".format(datetime.date.today().strftime("%Y-%m-%d"), fmt)
+        record(trends_path, copypath)
 
 if "all" in clus_answer:
     for coun in countries_plotted.keys():
@@ -735,5 +634,23 @@ if "all" in clus_answer:
 
 ## Write out plotting information - only if all clusters have run
 if print_files and "all" in clus_answer:
-    with open(tables_path+f'perVariant_countries_toPlot.json', 'w') as fh:
-        json.dump(countries_plotted, fh)
+    writer.write(tables_path+f'perVariant_countries_toPlot.json', json.dumps(countries_plotted))
+
+
+## Update the streaming frequencies with sequences submitted since the last run - only if all clusters have run,
+## so each tracked cluster sees every new sequence. Without a saved state, this starts from the full metadata.
+if print_files and "all" in clus_answer:
+    stream_file = tables_path+'streaming_frequencies.npz'
+    if os.path.isfile(stream_file):
+        stream = StreamingFrequencies.load(stream_file)
+    else:
+        stream = StreamingFrequencies(clus_to_run, overrides=country_overrides)
+    n_added = stream.update_from_metadata(meta, {clus: clusters[clus]['wanted_seqs'] for clus in clus_to_run})
+    if n_added:
+        stream.snapshot()
+    stream.save(stream_file)
+    print(f"Added {n_added} sequences to the streaming frequencies (state as of {stream.last_ingest})")
+
+
+## Wait for all file outputs to be written; raises if any of them failed
+writer.close()
@@ -0,0 +1,102 @@
+"""
+Content-addressed store for the dated copies of outputs.
+
+Outputs used to be copied to a date-stamped sibling on every run, so identical
+files piled up. Instead, every version of an output is stored once, under its
+hash, in a `.artifacts` folder next to it, and a manifest records which version
+each output had on each date. Dated names become hard links to the stored
+version (copies where links aren't possible), and `fetch` gives an output as
+of a date, also from the command line:
+
+    python artifact_store.py <output folder> <output name> [YYYY-MM-DD]
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import sys
+from shutil import copyfile
+
+store_folder = ".artifacts"
+
+
+def file_hash(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(folder):
+    # {output name: {date: hash}}
+    fname = os.path.join(folder, store_folder, "manifest.json")
+    if os.path.isfile(fname):
+        with open(fname) as fh:
+            return json.load(fh)
+    return {}
+
+
+def object_path(folder, digest):
+    return os.path.join(folder, store_folder, "objects", digest[:2], digest[2:])
+
+
+def record(path, dated_path=None, date=None):
+    """
+    Stores the current version of the output `path` (if it isn't stored yet) and
+    records it as that output's version on `date` (default today). If given,
+    `dated_path` becomes a link to the stored version. Returns the hash.
+    """
+    folder, name = os.path.split(path)
+    date = (date or datetime.date.today()).strftime("%Y-%m-%d")
+    digest = file_hash(path)
+
+    obj = object_path(folder, digest)
+    if not os.path.isfile(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        # a copy, not a link: the output itself gets overwritten by the next run
+        copyfile(path, obj + ".tmp")
+        os.replace(obj + ".tmp", obj)
+
+    manifest = load_manifest(folder)
+    manifest.setdefault(name, {})[date] = digest
+    with open(os.path.join(folder, store_folder, "manifest.json"), 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+
+    if dated_path is not None:
+        if os.path.lexists(dated_path):
+            os.remove(dated_path)
+        try:
+            os.link(obj, dated_path)
+        except OSError:
+            copyfile(obj, dated_path)
+    return digest
+
+
+def versions(path):
+    # {date: hash} of all recorded versions of the output `path`
+    folder, name = os.path.split(path)
+    return load_manifest(folder).get(name, {})
+
+
+def fetch(path, date=None):
+    """
+    Path to the stored version of the output `path` as of `date` (the latest
+    version recorded on or before it; default the latest), or None.
+    """
+    folder, _ = os.path.split(path)
+    date = (date or datetime.date.today()).strftime("%Y-%m-%d")
+    recorded = [d for d in versions(path) if d <= date]
+    if not recorded:
+        return None
+    return object_path(folder, versions(path)[max(recorded)])
+
+
+if __name__ == '__main__':
+    folder, name = sys.argv[1:3]
+    date = datetime.date.fromisoformat(sys.argv[3]) if len(sys.argv) > 3 else None
+    found = fetch(os.path.join(folder, name), date)
+    if found is None:
+        sys.exit(f"No version of {name} recorded by {date or 'today'}")
+    print(found)
@@ -0,0 +1,70 @@
+"""
+Small on-disk cache for computed arrays, keyed by a hash of the inputs.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from paths import cache_path
+
+
+def array_hash(*arrays, **params):
+    """
+    Hash of numeric arrays (values, dtype and shape) and JSON-able parameters.
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(f"{a.dtype}{a.shape}".encode())
+        h.update(a.tobytes())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def content_hash(obj, h=None):
+    """
+    Stable hash of nested dicts/lists/tuples of arrays, numbers, strings and dates
+    (anything else by its repr), e.g. a figure job.
+    """
+    top = h is None
+    h = hashlib.sha1() if top else h
+    if isinstance(obj, dict):
+        h.update(b"{")
+        for k in sorted(obj, key=str):
+            h.update(str(k).encode())
+            content_hash(obj[k], h)
+        h.update(b"}")
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for x in obj:
+            content_hash(x, h)
+        h.update(b"]")
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        a = np.ascontiguousarray(obj)
+        h.update(f"{a.dtype}{a.shape}".encode())
+        h.update(a.tobytes())
+    elif isinstance(obj, np.ndarray):
+        content_hash(obj.tolist(), h)
+    else:
+        h.update(f"{type(obj).__name__}:{obj!r};".encode())
+    return h.hexdigest() if top else h
+
+
+def cached_arrays(name, key, compute, path=None):
+    """
+    Returns the dict of arrays from `compute()`, stored as `{name}_{key}.npz` in the
+    cache directory; it is only computed (and saved) if that file isn't there yet.
+    """
+    path = cache_path if path is None else path
+    fname = os.path.join(path, f"{name}_{key[:16]}.npz")
+    if os.path.isfile(fname):
+        with np.load(fname) as data:
+            return {k: data[k] for k in data.files}
+
+    result = compute()
+    os.makedirs(path, exist_ok=True)
+    np.savez_compressed(fname, **result)
+    return result
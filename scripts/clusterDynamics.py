@@ -27,7 +27,6 @@ import pandas as pd
 import datetime
 import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
 from shutil import copyfile
 from collections import defaultdict
 from matplotlib.patches import Rectangle
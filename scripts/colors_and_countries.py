@@ -56,6 +56,8 @@ colors = [
 uk_countries = ['Scotland', 'England', 'Wales', 'Northern Ireland']
 countries_and_uk_list = [x for x in country_list if x!='United Kingdom'] + uk_countries
 all_countries = country_list + uk_countries
+# divisions that are also reported as a country of their own, mapped to the country they belong to
+country_overrides = {x: 'United Kingdom' for x in uk_countries}
 
 # For the main cluster, ran out of colors... try this hack.
 # palette = sns.color_palette("tab10", round(len(country_list)/2))
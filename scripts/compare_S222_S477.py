@@ -3,8 +3,7 @@ import pandas as pd
 import datetime
 import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
-from shutil import copyfile
+from artifact_store import record
 from collections import defaultdict
 from matplotlib.patches import Rectangle
 import matplotlib.patches as mpatches
@@ -253,7 +252,7 @@ plt.tight_layout()
 plt.savefig(figure_path+f"EUClusters_compare.{fmt}")
 trends_path = figure_path+f"EUClusters_compare.{fmt}"
 copypath = trends_path.replace("compare", "compare-{}".format(datetime.date.today().strftime("%Y-%m-%d")))
-copyfile(trends_path, copypath)
+record(trends_path, copypath)
 
 
 #for clus in clusters.keys():
@@ -1,19 +1,18 @@
-import matplotlib.patches as mpatches
 import pandas as pd
 import datetime
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from shutil import copyfile
+from artifact_store import record
 from collections import defaultdict
-from matplotlib.patches import Rectangle
-import matplotlib.patches as mpatches
 import copy
 import json
+import os
 from colors_and_countries import *
 from travel_data import *
 from clusters import *
 from helpers import *
+from count_cube import stacked_bands
+from stacked_tiles import tile_job, legend_job, render_tile, composite_tiles, draw_tiles
+from render_pool import render_all
 from bad_sequences import *
 
 # as with allClusterDynamics.py - run from within `ncov`, which must be a sister repository
@@ -243,94 +242,83 @@ countries_to_plot = all_num_seqs[all_num_seqs.has_20 == "*"].index
 
 country_week = {clus: {} for clus in clusters}
 
-#fig, ax1 = plt.subplots(nrows=1,figsize=(10,7))
-fs = 14
-rws = int(np.ceil((len(countries_to_plot)+1)/2))
-fig, axs = plt.subplots(nrows=rws, #len(countries_to_plot)+1, 
-    ncols=2, sharex=True,figsize=(9,11))
+# Stacked frequency bands of all clusters in all plotted countries at once, on the weeks of
+# total_data: clusters x countries x weeks counts, cumulated over clusters
+band_counts = np.array([clusters[clus]['cluster_data'].reindex(index=total_data.index, columns=countries_to_plot).fillna(0).values.T
+                        for clus in clus_keys], dtype=float)
+band_totals = total_data.reindex(columns=countries_to_plot).fillna(0).values.T
+lower, upper = stacked_bands(band_counts, band_totals)
+band_weeks = np.array([datetime.datetime.strptime("{}-W{}-1".format(*x), '%G-W%V-%u') for x in total_data.index])
+has_data = band_totals > 0
+
+plotted_weeks = band_weeks[has_data.any(axis=0)]
+min_week, max_week = plotted_weeks.min(), plotted_weeks.max()
+
+# The figure is a grid of tiles (legend first, then one per country, two per row); each tile is
+# rendered and cached on its own, so only tiles whose data changed are drawn again
+tiles_path = overall_trends_figs_path+"EUClusters_tiles/"
+os.makedirs(tiles_path, exist_ok=True)
+n_tiles = len(countries_to_plot)+1
+clus_colors = [clusters[clus]['col'] for clus in clus_keys]
+tile_jobs = [legend_job(tiles_path+"legend.png", [clusters[clus]["display_name"] for clus in clus_keys] + ["other"],
+                        clus_colors + [grey_color])]
 
-min_week = datetime.datetime(2020,12,31)
-max_week = datetime.datetime(2020,1,1)
-week_as_dates = {}
 json_output = {}
 json_output['countries'] = {}
 
 #for coun in [x for x in countries_to_plot]:
-for coun, ax in zip(countries_to_plot, fig.axes[1:]): #axs[1:]):
-    i=0
-    first_clus_count = []
-    ptchs = []
-
-    json_output['countries'][coun] = {'week': {}, 'total_sequences': {} }
-
-    for clus in clus_keys:#clusters.keys():
-        cluster_data = clusters[clus]['cluster_data']
-        if coun not in cluster_data:
-            i+=1
+for gi, coun in enumerate(countries_to_plot):
+    wks = has_data[gi]
+    week_as_dates = band_weeks[wks]
+
+    json_output['countries'][coun] = {'week': [datetime.datetime.strftime(x, "%Y-%m-%d") for x in week_as_dates],
+                                      'total_sequences': [int(x) for x in band_totals[gi, wks]]}
+    for ci, clus in enumerate(clus_keys):
+        # clusters never seen in the country are left out, as the web app expects
+        if coun not in clusters[clus]['cluster_data']:
             continue
-        week_as_date, cluster_count, total_count,\
-             unsmoothed_cluster_count, unsmoothed_total_count = non_zero_counts(cluster_data, total_data, coun)
-        #print(f"week as date for {clus} {coun}:\n")
-        #print(week_as_date)
-        mindat = min(week_as_date)
-        if mindat < min_week:
-            min_week = mindat
-        maxdat = max(week_as_date)
-        if maxdat > max_week:
-            max_week = maxdat
-
-        week_as_dates[coun] = week_as_date
-
-        json_output['countries'][coun][clusters[clus]['display_name']] = list(cluster_count)
-
-        country_week[clus][coun] = cluster_count/total_count
-
-        linesty = '-'
-        lab = clusters[clus]["display_name"] #f"{clus}"
-        if i == 0:
-            first_clus_count = [0] * len(cluster_count)
-        #if i == 1:
-        #    linesty = ':'
-        cluster_count = first_clus_count + cluster_count #unindented
-
-        ax.fill_between(week_as_date, first_clus_count/total_count, cluster_count/total_count, facecolor=clusters[clus]['col'])
-        patch = mpatches.Patch(color=clusters[clus]['col'], label=lab)
-
-        ptchs.append(patch)
-        if i == len(clus_keys)-1: # len(clusters)-1 :
-            ax.fill_between(week_as_date, cluster_count/total_count, 1, facecolor=grey_color)
-            patch = mpatches.Patch(color=grey_color, label=f"other")
-            ptchs.append(patch)
-        #if i == 0:
-        first_clus_count = cluster_count # unindented
-        i+=1
-    json_output['countries'][coun]['week'] = [datetime.datetime.strftime(x, "%Y-%m-%d") for x in week_as_date]
-    json_output['countries'][coun]['total_sequences'] = [int(x) for x in total_count]
-
-    ax.text(datetime.datetime(2020,6,1), 0.7, coun, fontsize=fs)
-    ax.tick_params(labelsize=fs*0.8)
-    #ax.set_ylabel('frequency')
-    #ax.legend(ncol=1, fontsize=fs*0.8, loc=2)
+        json_output['countries'][coun][clusters[clus]['display_name']] = list(band_counts[ci, gi, wks])
+        country_week[clus][coun] = band_counts[ci, gi, wks]/band_totals[gi, wks]
+
+    # the lowest tile of each column shows the dates
+    tile_jobs.append(tile_job(tiles_path+f"{coun}.png", coun, week_as_dates, lower[:, gi, wks], upper[:, gi, wks],
+                              clus_colors, (min_week, max_week), show_dates=(gi+1 >= n_tiles-2), other_color=grey_color))
+
+# Fit all plotted variants of a country jointly (multinomial logistic, 'other' as reference)
+# so that the fitted frequencies add up and we get growth advantages from one fit per country.
+growth_advantages = {}
+for coun in countries_to_plot:
+    clus_in_coun = [clus for clus in clus_keys if coun in clusters[clus]['cluster_data']]
+    counts = pd.concat([clusters[clus]['cluster_data'][coun] for clus in clus_in_coun] + [total_data[coun]], axis=1).fillna(0)
+    counts = counts[counts.iloc[:,-1] > 0]
+    if len(clus_in_coun) == 0 or len(counts) < 2:
+        continue
+    week_as_date = [datetime.datetime.strptime("{}-W{}-1".format(*x), '%G-W%V-%u') for x in counts.index]
+    fit = fit_multinomial([x.toordinal() for x in week_as_date], counts.iloc[:,:-1].values, counts.iloc[:,-1].values)
+
+    names = [clusters[clus]['display_name'] for clus in clus_in_coun]
+    growth_advantages[coun] = {
+        'week': [datetime.datetime.strftime(x, "%Y-%m-%d") for x in week_as_date],
+        'growth_advantage_per_week': {nam: fit['growth_advantage'][i]*7 for i, nam in enumerate(names)},
+        'fitted_frequencies': {nam: list(fit['frequencies'][:,i]) for i, nam in enumerate(names + ['other'])}
+    }
+
+with open(cluster_tables_path+f'EUClusters_growth_advantages.json', 'w') as fh:
+    json.dump(growth_advantages, fh)
 
 json_output['plotting_dates'] = {}
 json_output['plotting_dates']["min_date"] = datetime.datetime.strftime(min_week, "%Y-%m-%d")
 json_output['plotting_dates']["max_date"] = datetime.datetime.strftime(max_week, "%Y-%m-%d")
 
-fig.axes[0].legend(handles=ptchs, loc=3, fontsize=fs*0.7, ncol=3)
-fig.axes[0].axis('off')
-fig.autofmt_xdate(rotation=30)
-plt.show()
-plt.tight_layout()
-
 with open(cluster_tables_path+f'EUClusters_data.json', 'w') as fh:
      json.dump(json_output, fh)
 
-plt.savefig(overall_trends_figs_path+f"EUClusters_compare.png")
-
-plt.savefig(figure_path+f"EUClusters_compare.{fmt}")
 trends_path = figure_path+f"EUClusters_compare.{fmt}"
+composite_tiles(render_all(render_tile, tile_jobs), [overall_trends_figs_path+f"EUClusters_compare.png"])
+# the figure itself is drawn from the same tiles as one (vector) figure
+draw_tiles(tile_jobs, trends_path)
 copypath = trends_path.replace("compare", "compare-{}".format(datetime.date.today().strftime("%Y-%m-%d")))
-copyfile(trends_path, copypath)
+record(trends_path, copypath)
 
 
 #for clus in clusters.keys():
@@ -9,7 +9,8 @@ import matplotlib.cm as cm
 import numpy as np
 import math
 import datetime
-from shutil import copyfile
+from artifact_store import record
+from plot_helpers import savefig
 from collections import defaultdict
 import copy
 import pandas as pd
@@ -279,7 +280,7 @@ for country, date in countries_dates.items():
     fig.savefig(output_folder + "compare_lineages_" + country + "_" + date + ".png")
 
     fmt = "pdf"
-    plt.savefig(figure_path+f"compare_lineages_{country}.{fmt}")
+    savefig(fig, figure_path+f"compare_lineages_{country}.{fmt}")
     lineages_path = figure_path+f"compare_lineages_{country}.{fmt}"
     copypath = lineages_path.replace(country, "{}-{}".format(country, datetime.date.today().strftime("%Y-%m-%d")))
-    copyfile(lineages_path, copypath)
+    record(lineages_path, copypath)
@@ -19,6 +19,8 @@ from mutation_comparison import mutation_comparison
 
 cluster_tables_path = "cluster_tables"
 output_path = "web/data"
+# fields of the *_data.json files that the web app doesn't use
+nowcast_keys = ['nowcast_cluster_sequences', 'nowcast_total_sequences', 'uncertain']
 
 with open(os.path.join(cluster_tables_path, "EUClusters_data.json"), "r") as f:
     json_input = json.load(f)
@@ -103,8 +105,9 @@ def interpolate_per_cluster_data(cluster_data):
      i.e. the original data is not included.
     """
 
-    # NOTE: using "week" column as index
-    df = pd.DataFrame(cluster_data).set_index("week")
+    # NOTE: using "week" column as index. The nowcast fields (see incremental_series.py)
+    # aren't used here, and the `uncertain` flags can't be interpolated.
+    df = pd.DataFrame(cluster_data).set_index("week").drop(columns=nowcast_keys, errors='ignore')
 
     # Add rows for missing weeks. Fill values of the new rows wih NaN.
     old_index = df.index
@@ -132,6 +135,39 @@ def interpolate_per_cluster_data(cluster_data):
     return df_result.replace({np.nan: None}).to_dict('list')
 
 
+def frequency_bands(cluster_sequences, total_sequences, z=1.96):
+    """
+    Wilson score interval of the cluster frequency, for any number of weeks at once.
+    Weeks without sequences get NaN bounds.
+    """
+    k = np.asarray(cluster_sequences, dtype=float)
+    n = np.asarray(total_sequences, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.clip(k / n, 0, 1)
+        denom = 1 + z ** 2 / n
+        center = (p + z ** 2 / (2 * n)) / denom
+        half_width = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denom
+
+    has_data = n > 0
+    lower = np.where(has_data, np.clip(center - half_width, 0, 1), np.nan)
+    upper = np.where(has_data, np.clip(center + half_width, 0, 1), np.nan)
+    return lower, upper
+
+
+def observed_counts(cluster_data):
+    """
+    Unsmoothed (cluster, total) counts of the weeks that are in the data; interpolated
+    weeks, and series without unsmoothed counts, get a total of 0.
+    """
+    if "unsmoothed_total_sequences" not in cluster_data:
+        return np.zeros(len(cluster_data["week"])), np.zeros(len(cluster_data["week"]))
+    orig = np.array(cluster_data["orig"], dtype=bool)
+    cluster_sequences = np.array([0 if x is None else x for x in cluster_data["unsmoothed_cluster_sequences"]], dtype=float)
+    total_sequences = np.array([0 if x is None else x for x in cluster_data["unsmoothed_total_sequences"]], dtype=float)
+    return np.where(orig, cluster_sequences, 0), np.where(orig, total_sequences, 0)
+
+
 def update_per_cluster_distribution(cluster_data, country, distribution):
     cluster_data_aos = soa_to_aos(cluster_data)
 
@@ -146,29 +182,31 @@ def update_per_cluster_distribution(cluster_data, country, distribution):
         if total_sequences != 0:
             frequency = cluster_sequences / total_sequences
 
-        if len(distribution) == 0:
-            distribution.append({'week': week, 'frequencies': {country: frequency}, 'interp': {country: interp},
-                                 'orig': {country: orig}})
-        else:
-            has_this_week = False
-            for dist in distribution:
-                if week == dist['week']:
-                    has_this_week = True
-
-            if not has_this_week:
-                distribution.append({'week': week, 'frequencies': {country: frequency}, 'interp': {country: interp},
-                                     'orig': {country: orig}})
-            else:
-                for dist in distribution:
-                    if week == dist['week']:
-                        dist['frequencies'][country] = frequency
-                        dist['interp'][country] = interp
-                        dist['orig'][country] = orig
+        dist = None
+        for d in distribution:
+            if week == d['week']:
+                dist = d
+
+        if dist is None:
+            dist = {'week': week, 'frequencies': {}, 'frequencies_lower': {}, 'frequencies_upper': {},
+                    'interp': {}, 'orig': {}}
+            distribution.append(dist)
+
+        dist['frequencies'][country] = frequency
+        dist['interp'][country] = interp
+        dist['orig'][country] = orig
+
+        # interpolated weeks and weeks without sequences have no band
+        if cluster_datum['frequency_lower'] is not None:
+            dist['frequencies_lower'][country] = cluster_datum['frequency_lower']
+            dist['frequencies_upper'][country] = cluster_datum['frequency_upper']
 
 
 def convert_per_cluster_data(clusters):
     per_cluster_data_output = {"distributions": [], "country_names": []}
     per_cluster_data_output_interp = {"distributions": [], "country_names": []}
+    # (distribution, country, interpolated data) of every series, in order
+    series = []
 
     for _, cluster in clusters.items():
         display_name = cluster['display_name']
@@ -182,11 +220,26 @@ def convert_per_cluster_data(clusters):
                 per_cluster_data_output["country_names"] = \
                     sorted(list(set([country] + per_cluster_data_output["country_names"])))
                 cluster_data_interp = interpolate_per_cluster_data(cluster_data)
-                update_per_cluster_distribution(cluster_data_interp, country, distribution)
+                series.append((distribution, country, cluster_data_interp))
 
         per_cluster_data_output["distributions"].append(
             {'cluster': display_name, 'distribution': distribution})
 
+    # Confidence bands for all clusters, countries and weeks in one go, from the observed
+    # (unsmoothed) counts; interpolated weeks get no band
+    lengths = [len(cluster_data["week"]) for _, _, cluster_data in series]
+    bounds = np.cumsum([0] + lengths)
+    observed = [observed_counts(cluster_data) for _, _, cluster_data in series]
+    lower, upper = frequency_bands(np.concatenate([k for k, _ in observed] + [[]]),
+                                   np.concatenate([n for _, n in observed] + [[]]))
+    lower = np.where(np.isnan(lower), None, lower)
+    upper = np.where(np.isnan(upper), None, upper)
+
+    for (distribution, country, cluster_data), start, end in zip(series, bounds[:-1], bounds[1:]):
+        cluster_data["frequency_lower"] = lower[start:end].tolist()
+        cluster_data["frequency_upper"] = upper[start:end].tolist()
+        update_per_cluster_distribution(cluster_data, country, distribution)
+
     return per_cluster_data_output, per_cluster_data_output_interp
 
 
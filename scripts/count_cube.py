@@ -0,0 +1,344 @@
+"""
+Weekly sequence counts for many clusters at once, kept as a
+cluster x division x week cube.
+
+Counts are aggregated once at the finest level (division) and rolled up to
+country, region and global by summing along the geography tree. Divisions
+listed in `country_overrides` (the UK nations) additionally get a
+country-level row of their own. Once the cube is built, series at any level
+never go back to the metadata.
+"""
+
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from colors_and_countries import country_overrides
+
+geo_levels = ['division', 'country', 'region', 'global']
+
+
+def add_iso_weeks(some_meta):
+    # Drop sequences with incomplete dates and add ISO year/week columns in one vectorized pass
+    some_meta = some_meta[some_meta['date'].apply(lambda x: len(x) == 10 and 'XX' not in x)]
+    dates = pd.to_datetime(some_meta['date'], format="%Y-%m-%d", errors='coerce')
+    some_meta = some_meta[dates.notna()]
+    iso = dates[dates.notna()].dt.isocalendar()
+    return some_meta.assign(iso_year=iso['year'].astype(int), iso_week=iso['week'].astype(int))
+
+
+def week_as_date(weeks):
+    """
+    Converts (iso_year, iso_week) tuples to the Monday of that week.
+    """
+    return [pd.Timestamp.fromisocalendar(int(yr), int(wk), 1).to_pydatetime() for yr, wk in weeks]
+
+
+def get_division_summaries(meta, cluster_strains):
+    """
+    Summarises every cluster in every division in one grouped pass.
+    `cluster_strains` maps cluster name -> list of strains in the cluster.
+
+    Returns a tidy frame with one row per cluster, division and week (Monday of the
+    ISO week, as in the `*_data.json` files) holding the weekly `count`, plus the
+    division's `first_seq`, `last_seq` and `num_seqs` for that cluster.
+    """
+    membership = pd.DataFrame([(clus, strain) for clus, strains in cluster_strains.items() for strain in strains],
+                              columns=['cluster', 'strain'])
+    dated = add_iso_weeks(meta).merge(membership, on='strain')
+
+    geo_cols = ['cluster', 'region', 'country', 'division']
+    division_info = dated.groupby(geo_cols)['date'].agg(first_seq='min', last_seq='max', num_seqs='size')
+    weekly = dated.groupby(geo_cols + ['iso_year', 'iso_week']).size().rename('count').reset_index()
+    weekly['week'] = [x.strftime("%Y-%m-%d") for x in week_as_date(zip(weekly['iso_year'], weekly['iso_week']))]
+
+    return weekly.drop(columns=['iso_year', 'iso_week']).merge(division_info.reset_index(), on=geo_cols)
+
+
+def stacked_bands(counts, totals):
+    """
+    Frequency bands for stacked area plots of clusters x geographies x weeks `counts`
+    over geographies x weeks `totals`, for all geographies in one cumsum over clusters.
+    Returns (lower, upper), both clusters x geographies x weeks: cluster i fills
+    lower[i]..upper[i] and 'other' upper[-1]..1. Weeks without sequences are NaN.
+    """
+    cumulative = np.cumsum(counts, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(np.asarray(totals) > 0, 1/np.asarray(totals, dtype=float), np.nan)
+    return (cumulative - counts)*scale, cumulative*scale
+
+
+class DenseCounts:
+    """
+    Cluster x geography x week counts in a plain numpy array.
+    """
+
+    def __init__(self, values):
+        self.values = np.asarray(values)
+        self.shape = self.values.shape
+
+    @property
+    def nnz(self):
+        return int(np.count_nonzero(self.values))
+
+    def __getitem__(self, ci):
+        # geography x week counts of one cluster
+        return self.values[ci]
+
+    def aggregate(self, matrix):
+        # sum geographies into the rows of `matrix` (labels x geographies)
+        return DenseCounts(np.matmul(matrix, self.values))
+
+    def to_dense(self):
+        return self.values
+
+    def save_arrays(self):
+        return {'counts': self.values}
+
+
+class SparseCounts:
+    """
+    Cluster x geography x week counts as one CSR matrix with a row per
+    (cluster, geography) pair, for cubes that are mostly zeros.
+    """
+
+    def __init__(self, matrix, shape):
+        self.matrix = matrix.tocsr()
+        self.shape = tuple(shape)
+
+    @property
+    def nnz(self):
+        return int(self.matrix.nnz)
+
+    def __getitem__(self, ci):
+        n_geo = self.shape[1]
+        return self.matrix[ci*n_geo:(ci+1)*n_geo].toarray()
+
+    def aggregate(self, matrix):
+        from scipy import sparse
+        # the same geography sum for every cluster: a block diagonal of `matrix`
+        blocks = sparse.kron(sparse.identity(self.shape[0], dtype=matrix.dtype, format='csr'),
+                             sparse.csr_matrix(matrix), format='csr')
+        return SparseCounts(blocks @ self.matrix, (self.shape[0], matrix.shape[0], self.shape[2]))
+
+    def to_dense(self):
+        return self.matrix.toarray().reshape(self.shape)
+
+    def save_arrays(self):
+        return {'counts_data': self.matrix.data, 'counts_indices': self.matrix.indices,
+                'counts_indptr': self.matrix.indptr, 'counts_shape': np.array(self.shape)}
+
+
+def make_count_store(cluster_code, geo_code, week_code, shape, max_density=0.1):
+    """
+    Counts (cluster, geography, week) occurrences into a `DenseCounts` store, or a
+    `SparseCounts` store if less than `max_density` of the cells are non-zero.
+    """
+    from scipy import sparse
+    n_clusters, n_geo, n_weeks = shape
+    matrix = sparse.coo_matrix((np.ones(len(cluster_code), dtype=int), (cluster_code*n_geo + geo_code, week_code)),
+                               shape=(n_clusters*n_geo, n_weeks)).tocsr()
+    matrix.sum_duplicates()
+    if matrix.nnz > max_density*np.prod(shape):
+        return DenseCounts(matrix.toarray().reshape(shape))
+    return SparseCounts(matrix, shape)
+
+
+def load_count_store(data):
+    if 'counts' in data:
+        return DenseCounts(data['counts'])
+    from scipy import sparse
+    shape = tuple(data['counts_shape'])
+    matrix = sparse.csr_matrix((data['counts_data'], data['counts_indices'], data['counts_indptr']),
+                               shape=(shape[0]*shape[1], shape[2]))
+    return SparseCounts(matrix, shape)
+
+
+class CountCube:
+    """
+    Cluster counts (clusters x divisions x weeks) and total counts
+    (divisions x weeks) sharing one geography table and one week axis.
+    The cluster counts are held in a `DenseCounts` or `SparseCounts` store,
+    which both support the same indexing and aggregation.
+    """
+
+    def __init__(self, counts, totals, clusters, geography, weeks, overrides=None):
+        self.counts = DenseCounts(counts) if isinstance(counts, np.ndarray) else counts
+        self.totals = totals
+        self.clusters = list(clusters)
+        # one row per division with columns 'region', 'country', 'division'
+        self.geography = geography.reset_index(drop=True)
+        self.weeks = [tuple(int(x) for x in w) for w in weeks]
+        self.overrides = country_overrides if overrides is None else overrides
+        self._rollups = {}
+
+    @classmethod
+    def from_metadata(cls, meta, cluster_strains, min_week=None, overrides=None, max_density=0.1):
+        """
+        Builds the cube in a single pass over `meta`.
+        `cluster_strains` maps cluster name -> list of strains in the cluster.
+        Weeks before `min_week` (an (iso_year, iso_week) tuple) are dropped.
+        Cluster counts are stored sparse if less than `max_density` of the cells are non-zero.
+        """
+        dated = add_iso_weeks(meta)
+        if min_week is not None:
+            yr, wk = min_week
+            dated = dated[(dated['iso_year'] > yr) | ((dated['iso_year'] == yr) & (dated['iso_week'] >= wk))]
+
+        geo_cols = ['region', 'country', 'division']
+        geo_code, geography = pd.MultiIndex.from_frame(dated[geo_cols].astype(str)).factorize(sort=True)
+        geography = pd.DataFrame(list(geography), columns=geo_cols)
+        week_code, weeks = pd.MultiIndex.from_frame(dated[['iso_year', 'iso_week']]).factorize(sort=True)
+
+        n_geo, n_weeks = len(geography), len(weeks)
+        flat = geo_code*n_weeks + week_code
+        totals = np.bincount(flat, minlength=n_geo*n_weeks).reshape(n_geo, n_weeks)
+
+        cluster_code, rows = [], []
+        for ci, strains in enumerate(cluster_strains.values()):
+            in_cluster = np.where(dated['strain'].isin(strains).values)[0]
+            cluster_code.append(np.full(len(in_cluster), ci))
+            rows.append(in_cluster)
+        rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+        cluster_code = np.concatenate(cluster_code) if cluster_code else np.array([], dtype=int)
+        counts = make_count_store(cluster_code, geo_code[rows], week_code[rows],
+                                  (len(cluster_strains), n_geo, n_weeks), max_density=max_density)
+
+        return cls(counts, totals, cluster_strains.keys(), geography, list(weeks), overrides=overrides)
+
+    @classmethod
+    def from_cluster_tables(cls, tables_path, clusters):
+        """
+        Builds a country-level cube from the unsmoothed weekly counts in the
+        `{build_name}_data.json` files (as written by allClusterDynamics_faster.py)
+        of `clusters`, so stages in this repo can work without the metadata.
+        Each country is its own division and the region is unknown ('').
+        Clusters without a data file are skipped.
+        """
+        cluster_json = {}
+        for clus, clus_data in clusters.items():
+            fname = os.path.join(tables_path, f"{clus_data['build_name']}_data.json")
+            if os.path.isfile(fname):
+                with open(fname) as fh:
+                    cluster_json[clus] = json.load(fh)
+
+        countries = sorted({coun for data in cluster_json.values() for coun in data})
+        weeks = sorted({datetime.date.fromisoformat(w).isocalendar()[:2]
+                        for data in cluster_json.values() for series in data.values() for w in series['week']})
+        geo_index = {coun: i for i, coun in enumerate(countries)}
+        week_index = {w: i for i, w in enumerate(weeks)}
+
+        counts = np.zeros((len(cluster_json), len(countries), len(weeks)), dtype=int)
+        totals = np.zeros((len(countries), len(weeks)), dtype=int)
+        for ci, data in enumerate(cluster_json.values()):
+            for coun, series in data.items():
+                wi = [week_index[datetime.date.fromisoformat(w).isocalendar()[:2]] for w in series['week']]
+                counts[ci, geo_index[coun], wi] = series['unsmoothed_cluster_sequences']
+                # every cluster file has the same totals, but each only for its own weeks
+                totals[geo_index[coun], wi] = np.maximum(totals[geo_index[coun], wi], series['unsmoothed_total_sequences'])
+
+        geography = pd.DataFrame({'region': '', 'country': countries, 'division': countries})
+        return cls(counts, totals, cluster_json.keys(), geography, weeks, overrides={})
+
+    def membership(self, level):
+        """
+        Returns the labels of `level` and a (labels x divisions) 0/1 matrix saying
+        which divisions are summed into each label.
+        """
+        if level not in geo_levels:
+            raise ValueError(f"Unknown geography level {level}, options are {geo_levels}")
+
+        if level == 'global':
+            return ['global'], np.ones((1, len(self.geography)), dtype=int)
+        if level == 'division':
+            # division names are only unique within a country, so every division keeps its own row
+            return list(self.geography['division']), np.eye(len(self.geography), dtype=int)
+
+        labels = list(pd.unique(self.geography[level]))
+        if level == 'country':
+            labels += [x for x in pd.unique(self.geography['division']) if x in self.overrides and x not in labels]
+
+        row = {x: i for i, x in enumerate(labels)}
+        matrix = np.zeros((len(labels), len(self.geography)), dtype=int)
+        matrix[[row[x] for x in self.geography[level]], np.arange(len(self.geography))] = 1
+        if level == 'country':
+            for di, (coun, div) in enumerate(zip(self.geography['country'], self.geography['division'])):
+                if self.overrides.get(div) == coun:
+                    matrix[row[div], di] = 1
+
+        return labels, matrix
+
+    def rollup(self, level='country'):
+        """
+        Returns (labels, counts, totals) summed to `level`, with counts of shape
+        clusters x labels x weeks and totals of shape labels x weeks.
+        """
+        if level == 'division':
+            return list(self.geography['division']), self.counts, self.totals
+        if level not in self._rollups:
+            labels, matrix = self.membership(level)
+            self._rollups[level] = (labels, self.counts.aggregate(matrix), matrix @ self.totals)
+        return self._rollups[level]
+
+    def _frame(self, values, labels):
+        # same layout as the weekly frames used with `non_zero_counts`: (year, week) rows, one column per geography
+        index = pd.MultiIndex.from_tuples(self.weeks)
+        return pd.DataFrame(values.T, index=index, columns=labels)
+
+    def cluster_data(self, cluster, level='country'):
+        labels, counts, _ = self.rollup(level)
+        return self._frame(counts[self.clusters.index(cluster)], labels)
+
+    def total_data(self, level='country'):
+        labels, _, totals = self.rollup(level)
+        return self._frame(totals, labels)
+
+    def series(self, cluster, name, level='country'):
+        """
+        Weekly (cluster, total) counts of one geography as dense arrays along `weeks`,
+        e.g. as input for smoothing.
+        """
+        labels, counts, totals = self.rollup(level)
+        gi = labels.index(name)
+        return counts[self.clusters.index(cluster)][gi], totals[gi]
+
+    def week_counts(self, cluster, level='country', since=None):
+        """
+        {geography: {week: (cluster, total)}} for all weeks with sequences (on or after the
+        (iso_year, iso_week) tuple `since`), as taken by `incremental_series.update_cluster_series`.
+        """
+        labels, counts, totals = self.rollup(level)
+        cluster_counts = counts[self.clusters.index(cluster)]
+        week_str = [x.strftime("%Y-%m-%d") for x in week_as_date(self.weeks)]
+        first = 0 if since is None else int(np.searchsorted([yr*100 + wk for yr, wk in self.weeks], since[0]*100 + since[1]))
+
+        output = {}
+        for gi, wi in zip(*np.nonzero(totals[:, first:])):
+            output.setdefault(labels[gi], {})[week_str[first+wi]] = (int(cluster_counts[gi, first+wi]), int(totals[gi, first+wi]))
+        return output
+
+    def stacked_bands(self, clusters=None, level='country'):
+        """
+        `stacked_bands` of `clusters` (default all), stacked in that order, for every
+        geography at `level`. Returns (labels, lower, upper).
+        """
+        labels, counts, totals = self.rollup(level)
+        clusters = self.clusters if clusters is None else clusters
+        cluster_counts = np.array([counts[self.clusters.index(c)] for c in clusters])
+        return (labels,) + stacked_bands(cluster_counts, totals)
+
+    def save(self, fname):
+        np.savez_compressed(fname, **self.counts.save_arrays(), totals=self.totals, weeks=np.array(self.weeks),
+                            geography=self.geography[['region', 'country', 'division']].values.astype(str),
+                            clusters=np.array(self.clusters, dtype=str),
+                            overrides=json.dumps(self.overrides))
+
+    @classmethod
+    def load(cls, fname):
+        data = np.load(fname)
+        geography = pd.DataFrame(data['geography'], columns=['region', 'country', 'division'])
+        return cls(load_count_store(data), data['totals'], data['clusters'].tolist(), geography,
+                   data['weeks'].tolist(), overrides=json.loads(str(data['overrides'])))
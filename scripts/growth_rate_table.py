@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fits logistic growth rates (with bootstrap intervals) for every cluster and
+country with enough sequences, from the unsmoothed counts in the cluster tables.
+
+Results are cached in `growth_rates.json` next to the tables, keyed by a hash of
+each series, so a re-run only refits the series whose counts changed.
+Run from the repo root (`make growth-rates`).
+"""
+
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from clusters import clusters
+from count_cube import CountCube, week_as_date
+from helpers import bootstrap_logistic
+
+cluster_tables_path = "cluster_tables"
+cache_file = os.path.join(cluster_tables_path, "growth_rates.json")
+table_file = os.path.join(cluster_tables_path, "growth_rates.tsv")
+
+# series with fewer cluster sequences, or fewer weeks where the cluster was seen, are not fitted
+min_seqs = 50
+min_weeks = 4
+n_bootstraps = 100
+percentiles = (2.5, 97.5)
+# days are counted from a fixed date, so cached t50 values stay valid as weeks are added
+day_zero = datetime.date(2020, 1, 1)
+# per day; a flatter fit has no meaningful t50 (e.g. a series that is all cluster)
+min_growth_rate = 1e-5
+table_columns = ['cluster', 'country', 'num_seqs', 'weeks',
+                 'growth_rate', 'growth_rate_lower', 'growth_rate_upper', 't50']
+
+
+def series_hash(days, cluster, total):
+    """Hash of the weeks with data of one series, plus the settings that go into the fit."""
+    valid = total > 0
+    key = json.dumps([days[valid].tolist(), cluster[valid].tolist(), total[valid].tolist(),
+                      n_bootstraps, percentiles])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def fit_series(days, cluster, total, seed):
+    fit = bootstrap_logistic(days, cluster, total, n_bootstraps=n_bootstraps,
+                             seed=seed, percentiles=percentiles)
+    # t50 is only reported within the weeks of the table, where it is also a valid date
+    t50 = None
+    if abs(fit['growth_rate']) >= min_growth_rate and days.min() <= fit['t50'] <= days.max():
+        t50 = day_zero + datetime.timedelta(days=float(fit['t50']))
+    return {
+        'growth_rate': float(fit['growth_rate']),
+        'growth_rate_lower': float(fit['lower']),
+        'growth_rate_upper': float(fit['upper']),
+        't50': t50.strftime("%Y-%m-%d") if t50 else None,
+    }
+
+
+if __name__ == '__main__':
+    cube = CountCube.from_cluster_tables(cluster_tables_path, clusters)
+    days = np.array([(d.date() - day_zero).days for d in week_as_date(cube.weeks)])
+    labels, counts, totals = cube.rollup('country')
+
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as fh:
+            cache = json.load(fh)
+
+    results = {}
+    n_fitted = 0
+    for ci, clus in enumerate(cube.clusters):
+        cluster_counts = counts[ci]
+        for gi, coun in enumerate(labels):
+            cluster, total = cluster_counts[gi], totals[gi]
+            if cluster.sum() < min_seqs or (cluster > 0).sum() < min_weeks:
+                continue
+
+            key = f"{clus}|{coun}"
+            h = series_hash(days, cluster, total)
+            if key in cache and cache[key]['hash'] == h:
+                results[key] = cache[key]
+                continue
+
+            # seeded by the series itself, so a result doesn't depend on what else was refitted
+            results[key] = {'cluster': clus, 'country': coun, 'hash': h,
+                            'num_seqs': int(cluster.sum()), 'weeks': int((total > 0).sum()),
+                            **fit_series(days, cluster, total, seed=int(h[:8], 16))}
+            n_fitted += 1
+
+    print(f"Growth rates: {len(results)} series, {n_fitted} refitted, {len(results)-n_fitted} from cache")
+
+    with open(cache_file, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+
+    table = pd.DataFrame(list(results.values()), columns=table_columns).sort_values(['cluster', 'country'])
+    table.to_csv(table_file, sep="\t", index=False)
@@ -20,12 +20,202 @@ def fit_logistic(days, cluster, total):
     return sol
 
 
+def fit_logistic_batch(days, cluster, total, max_iter=100, tol=1e-8, ridge=1e-6):
+    """
+    Fits the binomial logistic model cluster ~ Bin(total, logistic(days, a, t50))
+    to many series at once by Newton's method (IRLS) with the analytic gradient
+    and Hessian.
+
+    `cluster` and `total` are arrays of shape (..., weeks), e.g. clusters x countries x weeks;
+    `days` is either (weeks,) or broadcastable to the same shape. Weeks with total=0 don't
+    contribute. `ridge` is a small penalty on the parameters that keeps series without
+    any change in frequency (e.g. all zero) finite, with a growth rate of ~0.
+
+    Returns a dict of arrays of shape (...): 'growth_rate' (a, per day, as in
+    fit_logistic), 't50', 'converged' and 'n_iter'.
+    """
+    k = np.asarray(cluster, dtype=float)
+    n = np.asarray(total, dtype=float)
+    t = np.broadcast_to(np.asarray(days, dtype=float), n.shape)
+
+    # centre time on each series' mean day so the intercept and slope are well conditioned
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_mean = np.where(n.sum(-1) > 0, (t*n).sum(-1)/n.sum(-1), t.mean(-1))
+    tc = t - t_mean[..., None]
+    scale = np.maximum(np.sqrt((n*tc**2).sum(-1)/np.maximum(n.sum(-1), 1)), 1e-12)
+    x = tc/scale[..., None]
+
+    def loglik(b0, b1):
+        eta = b0[..., None] + b1[..., None]*x
+        return (k*eta - n*np.logaddexp(0, eta)).sum(-1) - 0.5*ridge*(b0**2 + b1**2)
+
+    freq = np.clip((k.sum(-1) + 0.5)/(n.sum(-1) + 1), 1e-6, 1-1e-6)
+    b0 = np.log(freq/(1-freq))
+    b1 = np.zeros_like(b0)
+    ll = loglik(b0, b1)
+    converged = np.zeros(b0.shape, dtype=bool)
+    n_iter = np.zeros(b0.shape, dtype=int)
+
+    for it in range(max_iter):
+        p = 1/(1+np.exp(-(b0[..., None] + b1[..., None]*x)))
+        resid = k - n*p
+        w = n*p*(1-p)
+        g0 = resid.sum(-1) - ridge*b0
+        g1 = (resid*x).sum(-1) - ridge*b1
+        h00 = w.sum(-1) + ridge
+        h01 = (w*x).sum(-1)
+        h11 = (w*x**2).sum(-1) + ridge
+        det = h00*h11 - h01**2
+        step0 = (h11*g0 - h01*g1)/det
+        step1 = (h00*g1 - h01*g0)/det
+        step0 = np.where(converged, 0, step0)
+        step1 = np.where(converged, 0, step1)
+
+        # halve the step where it would lower the likelihood
+        for _ in range(30):
+            new_ll = loglik(b0 + step0, b1 + step1)
+            worse = new_ll < ll - 1e-12
+            if not worse.any():
+                break
+            step0 = np.where(worse, 0.5*step0, step0)
+            step1 = np.where(worse, 0.5*step1, step1)
+
+        b0 = b0 + step0
+        b1 = b1 + step1
+        ll = loglik(b0, b1)
+        n_iter = n_iter + ~converged
+        converged = converged | (np.maximum(np.abs(step0), np.abs(step1)) < tol)
+        if converged.all():
+            break
+
+    a = b1/scale
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t50 = t_mean - b0/a
+    return {'growth_rate': a, 't50': t50, 'converged': converged, 'n_iter': n_iter}
+
+
+def _fit_logistic_chunk(args):
+    # module level so it can be sent to worker processes
+    days, cluster, total = args
+    return fit_logistic_batch(days, cluster, total)
+
+
+def bootstrap_logistic(days, cluster, total, n_bootstraps=100, seed=0, percentiles=(25, 75),
+                       processes=None, chunk_size=20):
+    """
+    Bootstrap confidence intervals for logistic growth rates by resampling weeks.
+
+    Works on one series (`cluster`, `total` of shape (weeks,)) or on many at once
+    (shape (..., weeks), e.g. a slice of the count cube). Only weeks with total>0 are
+    resampled, separately for every series. All resample indices are drawn up front
+    from a generator seeded with `seed`, so results are reproducible and don't depend
+    on whether the fits run serially or in a pool of `processes` worker processes
+    (in chunks of `chunk_size` bootstraps).
+
+    Returns a dict with the fit to the full data ('growth_rate', 't50'), the bootstrap
+    growth rates and t50 (leading axis n_bootstraps) and the requested percentiles
+    of the growth rate ('lower' and 'upper').
+    """
+    k = np.asarray(cluster, dtype=float)
+    n = np.asarray(total, dtype=float)
+    t = np.broadcast_to(np.asarray(days, dtype=float), n.shape)
+    n_weeks = n.shape[-1]
+
+    # weeks with data first (in order), then empty weeks; resample from the first n_valid
+    valid = n > 0
+    order = np.argsort(~valid, axis=-1, kind='stable')
+    n_valid = valid.sum(-1)
+
+    rng = np.random.default_rng(seed)
+    draws = rng.random((n_bootstraps,) + n.shape)
+    rank = np.minimum((draws*n_valid[..., None]).astype(int), np.maximum(n_valid[..., None]-1, 0))
+    ind = np.take_along_axis(np.broadcast_to(order, draws.shape), rank, axis=-1)
+    # each bootstrap draws as many weeks as the series has with data
+    used = np.arange(n_weeks) < n_valid[..., None]
+
+    def resample(x):
+        return np.take_along_axis(np.broadcast_to(x, draws.shape), ind, axis=-1)
+
+    boot_days = resample(t)
+    boot_cluster = resample(k)*used
+    boot_total = resample(n)*used
+
+    chunks = [(boot_days[i:i+chunk_size], boot_cluster[i:i+chunk_size], boot_total[i:i+chunk_size])
+              for i in range(0, n_bootstraps, chunk_size)]
+    if processes:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes) as pool:
+            fits = list(pool.map(_fit_logistic_chunk, chunks))
+    else:
+        fits = [_fit_logistic_chunk(c) for c in chunks]
+
+    center = fit_logistic_batch(t, k, n)
+    bootstraps = np.concatenate([f['growth_rate'] for f in fits])
+    lower, upper = np.percentile(bootstraps, percentiles, axis=0)
+    return {'growth_rate': center['growth_rate'], 't50': center['t50'],
+            'bootstraps': bootstraps, 'bootstraps_t50': np.concatenate([f['t50'] for f in fits]),
+            'lower': lower, 'upper': upper}
+
+
+def fit_multinomial(days, cluster_counts, total, ridge=1e-4):
+    """
+    Fits all variants of one country jointly with a multinomial logistic model:
+    log(p_k/p_other) = intercept_k + growth_advantage_k * day, where 'other' are the
+    sequences not in any of the K variants.
+
+    `cluster_counts` has shape weeks x K (the variants must not overlap) and `total`
+    shape weeks. The likelihood and its gradient are evaluated over the whole
+    week x variant matrix at once, and all 2K parameters are found in one optimization.
+    `ridge` keeps variants without any sequences finite.
+
+    Returns a dict with 'growth_advantage' (per day, relative to 'other'), 'intercept',
+    'frequencies' (weeks x K+1 fitted frequencies, 'other' last) and 'success'.
+    """
+    from scipy.optimize import minimize
+
+    y = np.asarray(cluster_counts, dtype=float)
+    n = np.asarray(total, dtype=float)
+    other = np.maximum(n - y.sum(1), 0)
+    y = np.column_stack([y, other])
+    n_variants = y.shape[1] - 1
+
+    t = np.asarray(days, dtype=float)
+    t_mean = (t*n).sum()/n.sum() if n.sum() > 0 else t.mean()
+    scale = max(np.sqrt((n*(t-t_mean)**2).sum()/max(n.sum(), 1)), 1e-12)
+    x = (t - t_mean)/scale
+
+    def frequencies(params):
+        b0, b1 = params[:n_variants], params[n_variants:]
+        eta = np.column_stack([b0[None, :] + b1[None, :]*x[:, None], np.zeros(len(x))])
+        eta -= eta.max(1, keepdims=True)
+        p = np.exp(eta)
+        return p/p.sum(1, keepdims=True)
+
+    def cost(params):
+        p = frequencies(params)
+        resid = (y - y.sum(1, keepdims=True)*p)[:, :n_variants]
+        ll = (y*np.log(np.maximum(p, 1e-300))).sum() - 0.5*ridge*(params**2).sum()
+        grad = np.concatenate([resid.sum(0), (resid*x[:, None]).sum(0)]) - ridge*params
+        return -ll, -grad
+
+    sol = minimize(cost, np.zeros(2*n_variants), jac=True, method='L-BFGS-B')
+    b0, b1 = sol.x[:n_variants], sol.x[n_variants:]
+    return {'growth_advantage': b1/scale, 'intercept': b0 - b1*t_mean/scale,
+            'frequencies': frequencies(sol.x), 'success': sol.success}
+
+
 def trim_last_data_point(week_as_date, cluster_count, total_count, frac=0.2, keep_count=10):
     if total_count[-1]<frac*total_count[-2] and total_count[-1]<keep_count:
         return week_as_date[:-1], cluster_count[:-1], total_count[:-1]
 
     return week_as_date, cluster_count, total_count
 
+def gaussian_kernel(width=1, cutoff=1e-3):
+    # Normalized, symmetric Gaussian smoothing kernel, truncated where the weights drop below `cutoff` of the peak
+    radius = int(np.floor(width*np.sqrt(-2*np.log(cutoff))))
+    kernel = np.exp(-np.arange(-radius, radius+1)**2/2/width**2)
+    return kernel/kernel.sum()
+
 def non_zero_counts(cluster_data, total_data, country, smoothing=None):
 
     smooth = True
@@ -98,21 +288,19 @@ def load_case_data(countries):
 # n is the number of observations
 # x is the number of times you see the mutation
 # Distributions.Beta(a,b) is the Beta distribution
-# cdf is the cumulative distribution function (of the Beta distribution in this case)
+# ppf is the quantile function (inverse cdf) of the Beta distribution
+# x and n can be numbers or arrays of any (matching) shape, e.g. weeks x countries x clusters,
+# and all bounds are computed in one call. Entries with n=0 give nan.
 def bernoulli_estimator(x,n, dp=0.10):
     from scipy.stats import beta
-    naivemean = x/n
-    estmean = (x+0.5)/(n+1)
+    x = np.asarray(x, dtype=float)
+    n = np.asarray(n, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        naivemean = x/n
     a = x + 0.5
     b = n - x + 0.5
     #
-    lowerbound = 0.
-    while beta.cdf(lowerbound, a, b) < dp:
-        lowerbound += 0.01
-    #
-    higherbound = 1.
-    while beta.cdf(higherbound, a, b) > 1-dp:
-        higherbound -= 0.01
-
-    return naivemean, max(0,naivemean-lowerbound), max(0, higherbound-naivemean)
+    lowerbound = beta.ppf(dp, a, b)
+    higherbound = beta.ppf(1-dp, a, b)
 
+    return naivemean, np.maximum(0,naivemean-lowerbound), np.maximum(0, higherbound-naivemean)
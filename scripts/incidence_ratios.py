@@ -2,6 +2,7 @@ from helpers import *
 from paths import *
 from matplotlib import pyplot as plt
 from colors_and_countries import *
+from cache import array_hash, cached_arrays
 
 fmt='pdf'
 
@@ -9,6 +10,44 @@ countries = ['Spain', 'France', 'Belgium', 'United Kingdom', 'Switzerland', 'Net
               'Ireland', "Denmark", "Scotland", "Wales"]
 
 
+def incidence_by_week(case_data, countries):
+    # aligned weeks x countries weekly incidence per 100000, NaN where a country has no data for a week
+    weeks = sorted(set().union(*(case_data[c].keys() for c in countries)))
+    pop = np.array([popsizes[c] for c in countries], dtype=float)
+    incidence = np.array([[case_data[c].get(w, np.nan) for c in countries] for w in weeks], dtype=float)/pop*1e5
+    return weeks, incidence
+
+
+def log_incidence_ratios(incidence):
+    # weeks x countries x countries tensor of log10(incidence of row country / incidence of column country)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_incidence = np.log10(incidence)
+        return log_incidence[:,:,None] - log_incidence[:,None,:]
+
+
+def get_incidence_ratios(case_data, countries):
+    # weeks, incidence and the log-ratio tensor; the tensor is cached on disk by a hash of the incidence
+    weeks, incidence = incidence_by_week(case_data, countries)
+    key = array_hash(incidence, countries=countries, weeks=weeks)
+    ratios = cached_arrays("incidence_ratios", key, lambda: {'log_ratios': log_incidence_ratios(incidence)})
+    return weeks, incidence, ratios['log_ratios']
+
+
+def export_incidence_ratios(fname, weeks, countries, log_ratios):
+    # long table with one row per week and pair of countries
+    index = pd.MultiIndex.from_product([[w.strftime('%Y-%m-%d') for w in weeks], countries, countries],
+                                       names=['week', 'country', 'relative_to'])
+    pd.DataFrame({'log10_ratio': log_ratios.ravel()}, index=index).to_csv(fname, sep='\t')
+
+
+def plot_incidence_ratios(ax, log_ratios, week_index, weeks, countries):
+    img = ax.matshow(log_ratios[week_index], vmin=-2, vmax=2, cmap='coolwarm')
+    ax.set_xticks(range(len(countries)))
+    ax.set_xticklabels(countries, rotation=30, ha='left')
+    ax.text(0,len(countries)+.2, weeks[week_index].strftime('%Y-%m-%d'))
+    return img
+
+
 if __name__ == '__main__':
     case_data = load_case_data(countries)
     fig=plt.figure()
@@ -29,18 +68,12 @@ if __name__ == '__main__':
 
     fig, axs = plt.subplots(1,4, sharey=True, figsize=(12,3))
 
+    weeks, _, log_ratios = get_incidence_ratios(case_data, countries)
+    export_incidence_ratios('../cluster_scripts/figures/incidence_ratios.tsv', weeks, countries, log_ratios)
+
     for ax, week in zip(axs, [26, 29, 32, 35]):
         d = datetime.datetime.strptime(f"2020-W{week}-1", '%G-W%V-%u')
-        ratio = np.ones((len(countries), len(countries)))
-        for i1, c1 in enumerate(countries):
-            for i2, c2 in enumerate(countries):
-                if True:# i1<i2:
-                    ratio[i1,i2] = case_data[c1][d]/popsizes[c1]/case_data[c2][d]*popsizes[c2]
-
-        img = ax.matshow(np.log10(ratio), vmin=-2, vmax=2, cmap='coolwarm')
-        ax.set_xticks(range(len(countries)))
-        ax.set_xticklabels(countries, rotation=30, ha='left')
-        ax.text(0,len(countries)+.2, d.strftime('%Y-%m-%d'))
+        img = plot_incidence_ratios(ax, log_ratios, weeks.index(d), weeks, countries)
 
     axs[0].set_yticks(range(len(countries)))
     axs[0].set_yticklabels(countries, rotation=0)
@@ -0,0 +1,167 @@
+"""
+Incremental updates of the per-cluster `*_data.json` files.
+
+New (or revised) weekly counts are merged into the stored unsmoothed series,
+and the smoothed series is only recomputed for the tail that the Gaussian
+kernel can reach from the first changed week. A full run builds each series
+the same way, from an empty entry, so both give the same file. Entries that come out the same
+are left alone, and the file only needs to be rewritten if something changed.
+
+The observed series are never nowcast; the nowcast of the latest weeks (see nowcast.py)
+goes into separate fields, `nowcast_cluster_sequences`, `nowcast_total_sequences` and
+`uncertain`, which both modes recompute from the stored counts on every run.
+"""
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+from nowcast import nowcast
+
+nowcast_keys = ['nowcast_cluster_sequences', 'nowcast_total_sequences', 'uncertain']
+
+
+def load_cluster_json(fname):
+    # {country: entry} of a `*_data.json` file; empty if there is none yet
+    if os.path.isfile(fname):
+        with open(fname) as fh:
+            return json.load(fh)
+    return {}
+
+
+def stored_since(country_data, revision_weeks):
+    """
+    The (iso_year, iso_week) from which the counts of a stored entry can still change:
+    `revision_weeks` before its last week (late submissions), or None if nothing is stored.
+    A trimmed last week is after that, so it is merged again as well.
+    """
+    if not country_data or not country_data.get('week'):
+        return None
+    start = datetime.date.fromisoformat(country_data['week'][-1]) - datetime.timedelta(weeks=revision_weeks)
+    return tuple(start.isocalendar()[:2])
+
+
+def update_country_series(country_data, new_weeks, kernel, frac=0.1, keep_count=10, trim=True):
+    """
+    Merges `new_weeks` ({week: (cluster, total)}) into one country's entry of a
+    `*_data.json` file in place and returns the number of changed entries. With `trim`,
+    the last week is left out if it has far fewer sequences than the one before (like
+    `trim_last_data_point`); without it, the last week is kept for the nowcast.
+    """
+    radius = len(kernel)//2
+    for key in ['week', 'cluster_sequences', 'total_sequences',
+                'unsmoothed_cluster_sequences', 'unsmoothed_total_sequences']:
+        country_data.setdefault(key, [])
+
+    # the last stored week may have been trimmed for being incomplete; it is
+    # only ever at the end, so it comes back with the new counts.
+    raw = {w: (c, t) for w, c, t in zip(country_data['week'], country_data['unsmoothed_cluster_sequences'],
+                                         country_data['unsmoothed_total_sequences'])}
+    changed_weeks = [w for w, ct in new_weeks.items() if raw.get(w) != tuple(ct)]
+    if not changed_weeks:
+        return 0
+    raw.update({w: tuple(ct) for w, ct in new_weeks.items()})
+
+    weeks = sorted(raw)
+    unsmoothed_cluster = np.array([raw[w][0] for w in weeks])
+    unsmoothed_total = np.array([raw[w][1] for w in weeks])
+
+    # smooth on a calendar grid of weeks, where weeks without sequences count as zeros
+    grid = (np.array(weeks, dtype='datetime64[D]') - np.datetime64(weeks[0], 'D')).astype(int)//7
+
+    # only weeks within `radius` of a changed raw count can change after smoothing;
+    # to get those right, the convolution needs another `radius` of context on the left.
+    grid_start = max(0, grid[weeks.index(min(changed_weeks))] - radius)
+    grid_context = max(0, grid_start - radius)
+    start = int(np.searchsorted(grid, grid_start))
+    values = np.zeros((2, grid[-1] - grid_context + 1))
+    use = grid >= grid_context
+    values[:, grid[use] - grid_context] = [unsmoothed_cluster[use], unsmoothed_total[use]]
+    smoothed = np.array([np.convolve(v, kernel, mode='full')[radius:radius+len(v)] for v in values])
+    cluster_count, total_count = smoothed[:, grid[start:] - grid_context]
+
+    cluster_count = country_data['cluster_sequences'][:start] + [int(x) for x in cluster_count]
+    total_count = country_data['total_sequences'][:start] + [int(x) for x in total_count]
+    n_keep = len(weeks)
+    if trim and n_keep > 1 and total_count[-1] < frac*total_count[-2] and total_count[-1] < keep_count:
+        n_keep -= 1
+
+    new_series = {
+        'week': weeks[:n_keep],
+        'unsmoothed_cluster_sequences': [int(x) for x in unsmoothed_cluster[:n_keep]],
+        'unsmoothed_total_sequences': [int(x) for x in unsmoothed_total[:n_keep]],
+        'cluster_sequences': cluster_count[:n_keep],
+        'total_sequences': total_count[:n_keep],
+    }
+
+    n_changed = 0
+    for key, values in new_series.items():
+        old = country_data[key]
+        n_changed += sum(1 for i, x in enumerate(values) if i >= len(old) or old[i] != x)
+        n_changed += max(0, len(old) - len(values))
+        del old[len(values):]
+        for i, x in enumerate(values):
+            if i >= len(old):
+                old.append(x)
+            elif old[i] != x:
+                old[i] = x
+
+    return n_changed
+
+
+def smooth(values, kernel):
+    # convolution with the (symmetric) kernel along the last axis, with zeros beyond the ends
+    radius = len(kernel)//2
+    n = np.shape(values)[-1]
+    padded = np.pad(values, [(0, 0)]*(np.ndim(values) - 1) + [(radius, radius)])
+    return sum(w*padded[..., 2*radius-k:2*radius-k+n] for k, w in enumerate(kernel))
+
+
+def add_nowcast(entries, kernel, as_of, completeness, min_completeness=0.5):
+    """
+    Sets the nowcast fields of country entries in place, all of them at once: the
+    unsmoothed counts of each stored week divided by its completeness as of `as_of`,
+    smoothed like the observed series, and whether the week is uncertain. Without a
+    completeness estimate, the nowcast fields are removed. Returns the number of fields that changed.
+    """
+    entries = list(entries)
+    old = [{key: entry.pop(key, None) for key in nowcast_keys} for entry in entries]
+    with_weeks = [entry for entry in entries if entry.get('week')]
+    if completeness is not None and with_weeks:
+        # all series on one calendar grid of weeks: (cluster, total) x series x weeks
+        first = min(np.datetime64(entry['week'][0], 'D') for entry in with_weeks)
+        grids = [(np.array(entry['week'], dtype='datetime64[D]') - first).astype(int)//7 for entry in with_weeks]
+        n_weeks = max(grid[-1] for grid in grids) + 1
+        counts = np.zeros((2, len(with_weeks), n_weeks))
+        for i, (entry, grid) in enumerate(zip(with_weeks, grids)):
+            counts[:, i, grid] = [entry['unsmoothed_cluster_sequences'], entry['unsmoothed_total_sequences']]
+        grid_weeks = [tuple((first + np.timedelta64(7*k, 'D')).astype(datetime.date).isocalendar()[:2])
+                      for k in range(n_weeks)]
+        adjusted, _, uncertain = nowcast(counts, grid_weeks, as_of, completeness, min_completeness=min_completeness)
+        smoothed = smooth(adjusted, kernel)
+
+        for i, (entry, grid) in enumerate(zip(with_weeks, grids)):
+            entry['nowcast_cluster_sequences'] = [round(float(x), 2) for x in smoothed[0, i, grid]]
+            entry['nowcast_total_sequences'] = [round(float(x), 2) for x in smoothed[1, i, grid]]
+            entry['uncertain'] = [bool(u) for u in uncertain[grid]]
+
+    return sum(1 for entry, prev in zip(entries, old) for key in nowcast_keys if entry.get(key) != prev[key])
+
+
+def update_cluster_series(json_output, new_counts, kernel, as_of, completeness):
+    """
+    Applies {country: {week: (cluster, total)}} to the entries of one `*_data.json` file
+    in place, and redoes the nowcast fields of every country as of `as_of` (see
+    `add_nowcast`). With a completeness estimate, the last week isn't trimmed but nowcast.
+    Returns the number of changed entries; the caller only needs to write the file if any did.
+    """
+    n_changed = 0
+    for coun, new_weeks in new_counts.items():
+        if not new_weeks:
+            continue
+        n_changed += update_country_series(json_output.setdefault(coun, {}), new_weeks, kernel,
+                                           trim=completeness is None)
+    n_changed += add_nowcast(json_output.values(), kernel, as_of, completeness)
+    return n_changed
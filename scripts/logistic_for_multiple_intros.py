@@ -108,7 +108,6 @@ def non_zero_counts_intros(cluster_data, intro_id, country):
 fake_countries = ["United Kingdom", "Switzerland", "Spain", "Belgium"]
 
 fig = plt.figure()
-from scipy.stats import scoreatpercentile
 rates = {}
 n_bootstraps=100
 i = 0
@@ -116,10 +115,7 @@ for coun in list_of_seqs.keys():
     fake_coun = fake_countries[i]
     week_as_date, cluster_count, total_count = non_zero_counts_intros(intro_data, coun, intro_country)
     days = np.array([x.toordinal() for x in week_as_date])
-    mean_upper_lower = []
-    for x, n in zip(cluster_count, total_count):
-        mean_upper_lower.append(bernoulli_estimator(x,n))
-    mean_upper_lower = np.array(mean_upper_lower)
+    mean_upper_lower = np.array(bernoulli_estimator(cluster_count, total_count)).T
 
     # plt.plot(week_as_date, mean_upper_lower[:,0],
     #              marker='o', color=palette[i], label=coun, linestyle=sty)
@@ -129,19 +125,14 @@ for coun in list_of_seqs.keys():
                  color=country_styles[fake_coun]['c'],
                  linestyle=country_styles[fake_coun]['ls'])
 
-    center_fit = fit_logistic(days, cluster_count, total_count)
-    rates[coun] = {'center':center_fit['x'][0]}
-    bootstraps = []
-    for n in range(n_bootstraps):
-        # NOTE: bootstrap weeks to estimate confidence
-        ind = np.random.randint(len(cluster_count), size=len(cluster_count))
-        fit = fit_logistic(days[ind], cluster_count[ind], total_count[ind])
-        bootstraps.append(fit['x'][0])
-    rates[coun]['bootstraps'] = bootstraps
-    rates[coun]['lower'] = scoreatpercentile(bootstraps, 25)
-    rates[coun]['upper'] = scoreatpercentile(bootstraps, 75)
-
-    plt.plot(week_as_date, logistic(days, center_fit['x'][0], center_fit['x'][1]),
+    # NOTE: bootstrap weeks to estimate confidence
+    fit = bootstrap_logistic(days, cluster_count, total_count, n_bootstraps=n_bootstraps, seed=i)
+    rates[coun] = {'center':fit['growth_rate']}
+    rates[coun]['bootstraps'] = fit['bootstraps']
+    rates[coun]['lower'] = fit['lower']
+    rates[coun]['upper'] = fit['upper']
+
+    plt.plot(week_as_date, logistic(days, fit['growth_rate'], fit['t50']),
              c=country_styles[fake_coun]['c'], ls=country_styles[fake_coun]['ls'],
              label = f"{coun}, growth rate: {rates[coun]['center']*700:1.1f}({rates[coun]['lower']*700:1.1f}-{rates[coun]['upper']*700:1.1f})%/week")
     print(f"{coun} growth rate: {rates[coun]['center']*700:1.2f}% per week")
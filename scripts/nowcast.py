@@ -0,0 +1,114 @@
+"""
+Nowcasting of the latest weeks.
+
+Sequences from a week keep arriving for weeks after it, so the last weeks of any
+run are incomplete. Comparing successive snapshots of the total counts gives the
+fraction of a week's final count that is in after a given delay (the completeness).
+Counts of recent weeks are divided by it, and weeks that are still mostly missing
+are flagged as uncertain instead of being dropped.
+"""
+
+import datetime
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+snapshot_prefix = "total_counts-"
+
+
+def save_snapshot(total_data, folder, date=None):
+    """
+    Saves a weekly total count frame (indexed by (iso_year, iso_week), one column per
+    country) as the snapshot of `date` (default today).
+    """
+    date = datetime.date.today() if date is None else date
+    os.makedirs(folder, exist_ok=True)
+    total_data.to_csv(os.path.join(folder, f"{snapshot_prefix}{date:%Y-%m-%d}.tsv"), sep='\t')
+
+
+def load_snapshots(folder):
+    # [(date, frame)], oldest first
+    snapshots = []
+    for fname in sorted(glob.glob(os.path.join(folder, f"{snapshot_prefix}*.tsv"))):
+        date = datetime.date.fromisoformat(os.path.basename(fname)[len(snapshot_prefix):-4])
+        frame = pd.read_csv(fname, sep='\t', index_col=[0, 1])
+        snapshots.append((date, frame))
+    return snapshots
+
+
+def align_snapshots(snapshots):
+    """
+    Stacks snapshots into one snapshots x weeks x geographies array over all weeks
+    and geographies in any of them: 0 where a snapshot has a geography but no count
+    for a week, NaN where it doesn't have the geography at all (snapshots only hold
+    the countries of the clusters that were run).
+    Returns (dates, weeks, geographies, counts).
+    """
+    weeks = sorted(set().union(*(tuple(map(tuple, frame.index)) for _, frame in snapshots)))
+    geographies = sorted(set().union(*(frame.columns for _, frame in snapshots)))
+    index = pd.MultiIndex.from_tuples(weeks)
+    counts = np.array([frame.reindex(index=index).fillna(0).reindex(columns=geographies).values
+                       for _, frame in snapshots])
+    return [date for date, _ in snapshots], weeks, geographies, counts
+
+
+def week_lags(weeks, as_of):
+    """
+    Whole weeks between the end of each (iso_year, iso_week) and `as_of`;
+    0 for the week that just ended, negative for weeks that aren't over yet.
+    """
+    ends = np.array([datetime.date.fromisocalendar(int(yr), int(wk), 7) for yr, wk in weeks], dtype='datetime64[D]')
+    days = (np.datetime64(as_of, 'D') - ends).astype(int) - 1
+    return days//7
+
+
+def estimate_completeness(dates, weeks, counts, max_lag=8):
+    """
+    Fraction of a week's final count that is in after 0..max_lag weeks, from
+    snapshots (as returned by `align_snapshots`). Weeks that are more than `max_lag`
+    weeks old in the latest snapshot count as final, and every earlier snapshot of
+    such a week gives one observation at its lag, pooled over the geographies that
+    are in both that snapshot and the latest one.
+    Lags without observations are filled from their neighbours; the curve is made
+    non-decreasing and capped at 1. Returns None if there is nothing to compare.
+    """
+    # earlier snapshots x geographies that can be compared with the latest snapshot
+    present = ~np.isnan(counts).all(axis=1)
+    in_both = (present[:-1] & present[-1])[:, None, :]
+    earlier = np.where(in_both, counts[:-1], 0).sum(axis=-1)
+    final = np.where(in_both, counts[-1], 0).sum(axis=-1)
+    mature = week_lags(weeks, dates[-1]) > max_lag
+
+    lags = np.array([week_lags(weeks, date) for date in dates[:-1]]).reshape(-1, len(weeks))
+    use = mature & (lags >= 0) & (lags <= max_lag) & (final > 0)
+    if not use.any():
+        return None
+
+    observed = np.bincount(lags[use], weights=earlier[use], minlength=max_lag+1)
+    expected = np.bincount(lags[use], weights=final[use], minlength=max_lag+1)
+    has_data = expected > 0
+    completeness = np.interp(np.arange(max_lag+1), np.flatnonzero(has_data), observed[has_data]/expected[has_data])
+    return np.minimum(np.maximum.accumulate(completeness), 1)
+
+
+def nowcast(counts, weeks, as_of, completeness, min_completeness=0.5, axis=-1):
+    """
+    Divides counts (any array with a weeks axis `axis`, e.g. a whole count cube) by the
+    completeness of each week as of `as_of`. Returns (adjusted counts, completeness per
+    week, uncertain per week), where weeks with completeness below `min_completeness`
+    are uncertain. Weeks that aren't over yet are left as they are, with completeness
+    NaN, and are always uncertain.
+    """
+    lags = week_lags(weeks, as_of)
+    week_completeness = np.ones(len(weeks))
+    recent = (lags >= 0) & (lags < len(completeness))
+    week_completeness[recent] = completeness[lags[recent]]
+    week_completeness[lags < 0] = np.nan
+
+    shape = [1]*np.ndim(counts)
+    shape[axis] = len(weeks)
+    scale = np.where(lags < 0, 1, np.maximum(week_completeness, 1e-3))
+    adjusted = np.asarray(counts)/scale.reshape(shape)
+    return adjusted, week_completeness, (lags < 0) | (week_completeness < min_completeness)
@@ -0,0 +1,101 @@
+"""
+Writes output files on a background thread, so the pipeline doesn't wait for them.
+
+Tasks run one at a time, in the order they were submitted, so a task can rely on
+earlier ones (e.g. `record` a file after writing it). An append to a file whose
+latest pending task is also an append is merged into it, so repeated appends
+become one write. At most `max_pending` tasks wait at a time; submitting more
+blocks until the writer catches up. `flush` waits for all tasks and raises the
+first error any of them had.
+
+Text is passed as a string (formatted on the calling thread); anything handed to
+`call` (e.g. a frame to `to_csv`) must not be changed until it is written.
+"""
+
+import collections
+import threading
+
+
+class OutputWriter:
+
+    def __init__(self, max_pending=32):
+        self.max_pending = max_pending
+        # [kind, fname, payload]; payload is a list of strings, or (func, args, kwargs)
+        self.pending = collections.deque()
+        self.running = 0
+        self.errors = []
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._work, name="output-writer", daemon=True)
+        self.thread.start()
+
+    def _submit(self, kind, fname, payload):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("OutputWriter is closed")
+            if kind == 'append':
+                latest = next((task for task in reversed(self.pending) if task[1] == fname), None)
+                if latest is not None and latest[0] == 'append':
+                    latest[2].extend(payload)
+                    return
+            while len(self.pending) >= self.max_pending:
+                self.cond.wait()
+            self.pending.append([kind, fname, payload])
+            self.cond.notify_all()
+
+    def write(self, fname, text):
+        # replaces the content of `fname`
+        self._submit('write', fname, [text])
+
+    def append(self, fname, text):
+        self._submit('append', fname, [text])
+
+    def call(self, fname, func, *args, **kwargs):
+        # runs func(*args, **kwargs) in turn, e.g. a frame's `to_csv`; `fname` is the file it touches
+        self._submit('call', fname, (func, args, kwargs))
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                kind, fname, payload = self.pending.popleft()
+                self.running += 1
+                self.cond.notify_all()
+            try:
+                if kind == 'call':
+                    func, args, kwargs = payload
+                    func(*args, **kwargs)
+                else:
+                    with open(fname, 'w' if kind == 'write' else 'a') as fh:
+                        fh.write(''.join(payload))
+            except Exception as err:
+                self.errors.append((fname, err))
+            with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
+
+    def flush(self):
+        """
+        Waits until every submitted task is done, then raises the first error (if any).
+        """
+        with self.cond:
+            while self.pending or self.running:
+                self.cond.wait()
+            errors, self.errors = self.errors, []
+        if errors:
+            for fname, err in errors[1:]:
+                print(f"Also failed to write {fname}: {err!r}")
+            fname, err = errors[0]
+            raise RuntimeError(f"Failed to write {fname}") from err
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+            self.thread.join()
@@ -4,3 +4,5 @@ case_files = {'Spain': 'Spain.tsv', 'Norway': 'Norway.tsv', 'Switzerland': 'Swit
               'Scotland':'Scotland.csv',
               'Wales':'Wales_transformed.csv'}
 
+# Computed arrays that are expensive to recompute (see cache.py)
+cache_path = "../cluster_scripts/cache/"
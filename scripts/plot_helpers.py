@@ -0,0 +1,95 @@
+"""
+Shared settings and helpers for the figures.
+"""
+
+# base font size of the trend figures
+fs = 14
+
+
+def marker_size(n):
+    if n>100:
+        return 150
+    elif n>30:
+        return 100
+    elif n>10:
+        return 70
+    elif n>3:
+        return 50
+    elif n>1:
+        return 20
+    else:
+        return 5
+
+
+# Vector outputs (PDF/SVG/EPS) with dense layers, e.g. a marker per week and country or a
+# pie per tree node, are slow to write and to load. `savefig` rasterizes layers (all artists
+# of one kind in one axes) with more than `raster_threshold` elements, drawn at up to
+# `raster_dpi` but at most `max_raster_pixels` for the whole figure; the rest stays vector.
+raster_threshold = 1000
+raster_dpi = 200
+max_raster_pixels = 16e6
+vector_formats = ('pdf', 'svg', 'eps', 'ps')
+
+
+def layer_size(artist):
+    # markers, vertices or shapes an artist draws
+    from matplotlib.collections import Collection
+    from matplotlib.lines import Line2D
+    if isinstance(artist, Collection):
+        return max(len(artist.get_offsets()), len(artist.get_paths()))
+    if isinstance(artist, Line2D):
+        return len(artist.get_xdata())
+    return 1
+
+
+def data_layers(fig):
+    """
+    {(axes index, artist type name): [artists]} of the collections, lines and patches
+    shown in the axes of `fig` (not text, spines or axes backgrounds).
+    """
+    from matplotlib.collections import Collection
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Patch
+    from matplotlib.spines import Spine
+
+    layers = {}
+    for ai, ax in enumerate(fig.axes):
+        for artist in ax.get_children():
+            if not isinstance(artist, (Collection, Line2D, Patch)) or isinstance(artist, Spine) or artist is ax.patch \
+                    or not artist.get_visible():
+                continue
+            layers.setdefault((ai, type(artist).__name__), []).append(artist)
+    return layers
+
+
+def rasterize_layers(fig, threshold=raster_threshold, layers=None):
+    """
+    Rasterizes the layers of `fig` with more than `threshold` elements and keeps the
+    others vector. `layers` maps artist type names (e.g. 'PathCollection') to True or
+    False to force a kind of layer either way. Returns the number of rasterized layers.
+    """
+    layers = {} if layers is None else layers
+    n_rasterized = 0
+    for (_, kind), artists in data_layers(fig).items():
+        rasterize = layers.get(kind, sum(layer_size(a) for a in artists) > threshold)
+        for artist in artists:
+            artist.set_rasterized(rasterize)
+        n_rasterized += rasterize
+    return n_rasterized
+
+
+def budget_dpi(fig, dpi=raster_dpi, max_pixels=max_raster_pixels):
+    # `dpi`, lowered so the whole figure would take at most `max_pixels`
+    width, height = fig.get_size_inches()
+    return min(dpi, (max_pixels/(width*height))**0.5)
+
+
+def savefig(fig, fname, threshold=raster_threshold, layers=None, dpi=None, **kwargs):
+    """
+    `fig.savefig`, rasterizing dense layers (see `rasterize_layers`) if `fname` is a
+    vector format; those are drawn at `budget_dpi`. Raster formats are saved as usual.
+    """
+    if fname.rsplit('.', 1)[-1].lower() in vector_formats:
+        rasterize_layers(fig, threshold=threshold, layers=layers)
+        dpi = budget_dpi(fig) if dpi is None else dpi
+    fig.savefig(fname, dpi=dpi, **kwargs)
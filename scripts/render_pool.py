@@ -0,0 +1,87 @@
+"""
+Renders figures headless (Agg backend) in a pool of worker processes.
+
+A job is a picklable dict with everything a figure shows, including its output path
+'fname', and the render function (module level, so workers can unpickle it) draws
+and saves it and returns the path. Workers are forked, so the calling script isn't
+run again in each of them; where fork isn't available, jobs are rendered one after
+another.
+
+Rendered outputs are recorded in a `.render_cache.json` manifest in their folder,
+with a hash of the job, the plotting code and the matplotlib style. A job whose
+output is still there with the same hash is skipped.
+"""
+
+import inspect
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import content_hash
+
+cache_manifest = ".render_cache.json"
+
+
+def use_agg():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def render_version(render):
+    # the render function's module and the shared plot settings, plus the matplotlib version and style
+    import matplotlib
+    import plot_helpers
+    sources = [inspect.getsource(inspect.getmodule(render)), inspect.getsource(plot_helpers)]
+    return content_hash([sources, matplotlib.__version__, sorted((k, repr(v)) for k, v in matplotlib.rcParams.items())])
+
+
+def load_manifest(folder):
+    fname = os.path.join(folder, cache_manifest)
+    if os.path.isfile(fname):
+        with open(fname) as fh:
+            return json.load(fh)
+    return {}
+
+
+def render_all(render, jobs, processes=None, cache=True):
+    """
+    Returns the output paths of all jobs, in order, rendering only those that changed
+    (all of them with cache=False). An exception in any job is raised here once all
+    running jobs are done.
+    """
+    jobs = list(jobs)
+    processes = processes or os.cpu_count() or 1
+    use_agg()
+
+    version = render_version(render)
+    keys = [content_hash([job, version]) for job in jobs]
+    manifests = {}
+    todo = []
+    for job, key in zip(jobs, keys):
+        folder, name = os.path.split(job['fname'])
+        manifest = manifests.setdefault(folder, load_manifest(folder))
+        if cache and manifest.get(name) == key and os.path.isfile(job['fname']):
+            continue
+        # a new file rather than overwriting in place, which would also change links to the old one
+        if os.path.lexists(job['fname']):
+            os.remove(job['fname'])
+        todo.append(job)
+
+    if processes == 1 or len(todo) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for job in todo:
+            render(job)
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes, len(todo)), initializer=use_agg,
+                                 mp_context=multiprocessing.get_context('fork')) as pool:
+            list(pool.map(render, todo))
+
+    for job, key in zip(jobs, keys):
+        folder, name = os.path.split(job['fname'])
+        manifests[folder][name] = key
+    for folder, manifest in manifests.items():
+        with open(os.path.join(folder, cache_manifest), 'w') as fh:
+            json.dump(manifest, fh, indent=1, sort_keys=True)
+
+    print(f"Rendered {len(todo)} figures, {len(jobs)-len(todo)} unchanged (cache hits)")
+    return [job['fname'] for job in jobs]
@@ -0,0 +1,141 @@
+"""
+The EUClusters comparison figure as independent tiles: one stacked frequency
+panel per country plus a legend tile, each rendered on its own (in parallel and
+cached, see render_pool.py) and then put together into the grid by
+`composite_tiles`. Adding a country or a week of data for one country only
+re-renders the tiles that changed. That composite is a bitmap, so vector outputs
+are drawn by `draw_tiles` instead, with the same tiles as axes of one figure.
+
+Tiles have a fixed size and the same top margin, so the axes line up in the grid;
+tiles at the bottom of a column are taller to make room for the dates.
+"""
+
+import datetime
+
+import numpy as np
+
+from plot_helpers import fs, savefig
+
+# inches
+tile_width = 4.5
+tile_height = 1.8
+date_height = 0.6
+top_margin = 0.1
+bottom_margin = 0.1
+dpi = 100
+
+
+def tile_job(fname, country, weeks, lower, upper, colors, xlim, show_dates=False, other_color="#cccccc"):
+    """
+    One country's stacked panel: cluster i fills lower[i]..upper[i] over `weeks`
+    (as from `count_cube.stacked_bands`), in colors[i], and the rest is 'other'.
+    """
+    return {'fname': fname, 'kind': 'country', 'country': country, 'weeks': list(weeks),
+            'lower': np.asarray(lower), 'upper': np.asarray(upper), 'colors': list(colors),
+            'other_color': other_color, 'xlim': list(xlim), 'show_dates': show_dates}
+
+
+def legend_job(fname, labels, colors):
+    return {'fname': fname, 'kind': 'legend', 'labels': list(labels), 'colors': list(colors)}
+
+
+def tile_size(show_dates):
+    return tile_width, tile_height + (date_height if show_dates else 0)
+
+
+def axes_rect(show_dates):
+    # (left, bottom, width, height) of the axes within a tile, in inches
+    height = tile_size(show_dates)[1]
+    axes_height = tile_height - top_margin - bottom_margin
+    return 0.12*tile_width, height - top_margin - axes_height, 0.85*tile_width, axes_height
+
+
+def tile_figure(show_dates):
+    import matplotlib.pyplot as plt
+
+    width, height = tile_size(show_dates)
+    fig = plt.figure(figsize=(width, height), dpi=dpi)
+    left, bottom, w, h = axes_rect(show_dates)
+    ax = fig.add_axes([left/width, bottom/height, w/width, h/height])
+    return fig, ax
+
+
+def draw_tile(ax, job):
+    import matplotlib.patches as mpatches
+
+    if job['kind'] == 'legend':
+        ptchs = [mpatches.Patch(color=c, label=lab) for lab, c in zip(job['labels'], job['colors'])]
+        ax.legend(handles=ptchs, loc=3, fontsize=fs*0.7, ncol=3)
+        ax.axis('off')
+    else:
+        weeks = job['weeks']
+        for lower, upper, color in zip(job['lower'], job['upper'], job['colors']):
+            ax.fill_between(weeks, lower, upper, facecolor=color)
+        ax.fill_between(weeks, job['upper'][-1], 1, facecolor=job['other_color'])
+
+        ax.text(datetime.datetime(2020,6,1), 0.7, job['country'], fontsize=fs)
+        ax.tick_params(labelsize=fs*0.8)
+        ax.set_xlim(*job['xlim'])
+        ax.set_ylim(0, 1)
+        if job['show_dates']:
+            for label in ax.get_xticklabels():
+                label.set_rotation(30)
+                label.set_horizontalalignment('right')
+        else:
+            ax.tick_params(labelbottom=False)
+
+
+def render_tile(job):
+    import matplotlib.pyplot as plt
+
+    fig, ax = tile_figure(job.get('show_dates', False))
+    draw_tile(ax, job)
+    fig.savefig(job['fname'], dpi=dpi)
+    plt.close(fig)
+    return job['fname']
+
+
+def composite_tiles(fnames, out_fnames, ncols=2):
+    """
+    Puts the tile images `fnames` into a grid, row by row, and saves it to each of
+    `out_fnames` (as an image, also in a PDF; see `draw_tiles` for vector output).
+    """
+    import matplotlib.image as mpimg
+
+    tiles = [mpimg.imread(f) for f in fnames]
+    width = max(t.shape[1] for t in tiles)
+    rows = []
+    for i in range(0, len(tiles), ncols):
+        row = tiles[i:i+ncols]
+        canvas = np.ones((max(t.shape[0] for t in row), width*ncols, 4))
+        for j, t in enumerate(row):
+            canvas[:t.shape[0], j*width:j*width+t.shape[1], :t.shape[2]] = t
+        rows.append(canvas)
+    image = np.vstack(rows)
+    for fname in out_fnames:
+        mpimg.imsave(fname, image, dpi=dpi)
+    return image
+
+
+def draw_tiles(jobs, fname, ncols=2):
+    """
+    Draws the tiles of `jobs` as axes of one figure, in the same grid as
+    `composite_tiles`, and saves it to `fname`.
+    """
+    import matplotlib.pyplot as plt
+
+    rows = [jobs[i:i+ncols] for i in range(0, len(jobs), ncols)]
+    heights = [max(tile_size(job.get('show_dates', False))[1] for job in row) for row in rows]
+    width, height = tile_width*ncols, sum(heights)
+    fig = plt.figure(figsize=(width, height))
+    row_top = height
+    for row, row_height in zip(rows, heights):
+        for j, job in enumerate(row):
+            # tiles are aligned at the top of their row, like in the composite
+            show_dates = job.get('show_dates', False)
+            left, bottom, w, h = axes_rect(show_dates)
+            bottom += row_top - tile_size(show_dates)[1]
+            draw_tile(fig.add_axes([(j*tile_width + left)/width, bottom/height, w/width, h/height]), job)
+        row_top -= row_height
+    savefig(fig, fname)
+    plt.close(fig)
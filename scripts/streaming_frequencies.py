@@ -0,0 +1,207 @@
+"""
+Online cluster frequencies from exponentially weighted counts.
+
+Instead of recounting the whole metadata every run, each new sequence adds a
+weight of exp(rate*(date - origin)) to its geography's total and to the counts
+of the clusters it is in, with rate = log(2)/half_life. Since frequencies are
+ratios, growing the weight of new sequences is the same as decaying the old
+ones, so an update only touches the entries of that sequence. The weights are
+rescaled (and the origin moved) now and then so they don't overflow.
+
+The state is clusters x geographies counts plus per-geography totals, and can
+be saved and loaded so a run only has to add what was submitted since the last.
+"""
+
+import datetime
+import json
+
+import numpy as np
+import pandas as pd
+
+# rescale weights once their exponent gets this large
+max_exponent = 50.0
+
+
+def to_date(x):
+    if isinstance(x, str):
+        return datetime.date.fromisoformat(x)
+    if isinstance(x, datetime.datetime):
+        return x.date()
+    return x
+
+
+class StreamingFrequencies:
+    """
+    Exponentially weighted cluster frequencies per geography.
+
+    Geographies are added as sequences from them arrive. `overrides` maps divisions
+    that are also reported as a country of their own (e.g. Scotland) to their country,
+    like in `CountCube`; their sequences count for both.
+    """
+
+    def __init__(self, clusters, geographies=(), half_life=14, origin=None, overrides=None):
+        self.clusters = list(clusters)
+        self.geographies = list(geographies)
+        self.half_life = half_life
+        self.rate = np.log(2)/half_life
+        self.origin = to_date(origin) if origin is not None else None
+        self.overrides = {} if overrides is None else dict(overrides)
+
+        self.counts = np.zeros((len(self.clusters), len(self.geographies)))
+        self.totals = np.zeros(len(self.geographies))
+        # newest collection date seen, the submission date up to which sequences were added,
+        # and the strains added that were submitted on that date (which may still get more)
+        self.last_date = None
+        self.last_ingest = None
+        self.last_ingest_strains = set()
+        # (iso_year, iso_week) -> clusters x geographies frequencies
+        self.snapshots = {}
+
+        self._cluster_index = {c: i for i, c in enumerate(self.clusters)}
+        self._geo_index = {g: i for i, g in enumerate(self.geographies)}
+
+    def _geo(self, geo):
+        if geo not in self._geo_index:
+            self._geo_index[geo] = len(self.geographies)
+            self.geographies.append(geo)
+            self.counts = np.hstack([self.counts, np.zeros((len(self.clusters), 1))])
+            self.totals = np.append(self.totals, 0.0)
+        return self._geo_index[geo]
+
+    def _rescale(self, date):
+        # move the origin to `date`; all weights shrink by the same factor
+        shift = (date - self.origin).days
+        scale = np.exp(-self.rate*shift)
+        self.counts *= scale
+        self.totals *= scale
+        self.origin = date
+
+    def _weights(self, dates):
+        if self.origin is None:
+            self.origin = min(dates)
+        days = np.array([(d - self.origin).days for d in dates], dtype=float)
+        if days.max(initial=0) * self.rate > max_exponent:
+            self._rescale(max(dates))
+            days = np.array([(d - self.origin).days for d in dates], dtype=float)
+        return np.exp(self.rate*days)
+
+    def _seen(self, dates):
+        newest = max(dates)
+        if self.last_date is None or newest > self.last_date:
+            self.last_date = newest
+
+    def add(self, date, geo, clusters=(), division=None):
+        """
+        Adds one sequence collected on `date` in country `geo` (and `division`, if
+        that is in `overrides`) that belongs to `clusters`.
+        """
+        date = to_date(date)
+        weight = self._weights([date])[0]
+        geos = [geo] + ([division] if division in self.overrides else [])
+        for g in geos:
+            gi = self._geo(g)
+            self.totals[gi] += weight
+            for clus in clusters:
+                self.counts[self._cluster_index[clus], gi] += weight
+        self._seen([date])
+
+    def update_from_metadata(self, meta, cluster_strains, ingest_col='date_submitted'):
+        """
+        Adds all sequences in `meta` that weren't added before: those submitted after
+        the last update, by whole days of `ingest_col` (falls back to the collection
+        date if there is no such column), and those of the last day not added yet.
+        `cluster_strains` is {cluster: strains}; clusters the state doesn't track are
+        ignored. Rows without a full date are skipped.
+        Returns the number of sequences added.
+        """
+        meta = meta[meta['date'].str.len() == 10]
+        meta = meta[~meta['date'].str.contains('X')]
+        if ingest_col not in meta.columns:
+            ingest_col = 'date'
+        if self.last_ingest is not None:
+            day, last_day = meta[ingest_col].str[:10], self.last_ingest.isoformat()
+            meta = meta[(day > last_day) | ((day == last_day) & ~meta['strain'].isin(self.last_ingest_strains))]
+        if len(meta) == 0:
+            return 0
+
+        dates = [datetime.date.fromisoformat(d) for d in meta['date']]
+        weights = self._weights(dates)
+        geo_codes = [np.array([self._geo(c) for c in meta['country']])]
+        if self.overrides:
+            is_override = meta['division'].isin(self.overrides.keys()).values
+            geo_codes.append(np.array([self._geo(d) if o else -1 for d, o in zip(meta['division'], is_override)]))
+
+        in_cluster = {clus: meta['strain'].isin(set(strains)).values for clus, strains in cluster_strains.items()
+                      if clus in self._cluster_index}
+        for gi in geo_codes:
+            has_geo = gi >= 0
+            np.add.at(self.totals, gi[has_geo], weights[has_geo])
+            for clus, mask in in_cluster.items():
+                mask = mask & has_geo
+                np.add.at(self.counts[self._cluster_index[clus]], gi[mask], weights[mask])
+
+        self._seen(dates)
+        last_ingest = to_date(meta[ingest_col].max()[:10])
+        if self.last_ingest is None or last_ingest > self.last_ingest:
+            self.last_ingest = last_ingest
+            self.last_ingest_strains = set()
+        is_last = meta[ingest_col].str[:10] == self.last_ingest.isoformat()
+        self.last_ingest_strains.update(meta.loc[is_last, 'strain'])
+        return len(meta)
+
+    def frequencies(self):
+        """Clusters x geographies frequencies (NaN for geographies without sequences)."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.totals > 0, self.counts/self.totals, np.nan)
+
+    def effective_totals(self, as_of=None):
+        """Weighted number of sequences per geography, with weights decayed to `as_of`."""
+        as_of = to_date(as_of) if as_of is not None else self.last_date
+        if as_of is None:
+            return self.totals.copy()
+        return self.totals*np.exp(-self.rate*(as_of - self.origin).days)
+
+    def frequency_frame(self):
+        return pd.DataFrame(self.frequencies(), index=self.clusters, columns=self.geographies)
+
+    def snapshot(self, week=None):
+        """
+        Stores the current frequencies for `week` ((iso_year, iso_week), by default the
+        week of the newest sequence), replacing an earlier snapshot of the same week.
+        """
+        if week is None:
+            week = tuple(self.last_date.isocalendar()[:2])
+        self.snapshots[tuple(week)] = self.frequencies()
+        return week
+
+    def save(self, fname):
+        weeks = sorted(self.snapshots)
+        # snapshots of older weeks may have fewer geographies; pad them with NaN
+        snapshots = np.full((len(weeks),) + self.counts.shape, np.nan)
+        for i, week in enumerate(weeks):
+            snap = self.snapshots[week]
+            snapshots[i, :, :snap.shape[1]] = snap
+        state = {'half_life': self.half_life, 'overrides': self.overrides,
+                 'origin': self.origin.isoformat() if self.origin else None,
+                 'last_date': self.last_date.isoformat() if self.last_date else None,
+                 'last_ingest': self.last_ingest.isoformat() if self.last_ingest else None}
+        np.savez_compressed(fname, counts=self.counts, totals=self.totals,
+                            clusters=np.array(self.clusters, dtype=str),
+                            geographies=np.array(self.geographies, dtype=str),
+                            snapshot_weeks=np.array(weeks, dtype=int).reshape(-1, 2),
+                            snapshots=snapshots, state=json.dumps(state),
+                            last_ingest_strains=np.array(sorted(self.last_ingest_strains), dtype=str))
+
+    @classmethod
+    def load(cls, fname):
+        data = np.load(fname)
+        state = json.loads(str(data['state']))
+        stream = cls(data['clusters'].tolist(), data['geographies'].tolist(), half_life=state['half_life'],
+                     origin=state['origin'], overrides=state['overrides'])
+        stream.counts = data['counts']
+        stream.totals = data['totals']
+        stream.last_date = to_date(state['last_date']) if state['last_date'] else None
+        stream.last_ingest = to_date(state['last_ingest']) if state['last_ingest'] else None
+        stream.last_ingest_strains = set(data['last_ingest_strains'].tolist())
+        stream.snapshots = {tuple(week): snap for week, snap in zip(data['snapshot_weeks'].tolist(), data['snapshots'])}
+        return stream
@@ -3,22 +3,35 @@ import glob, datetime
 from colors_and_countries import *
 
 
-travel_volume = {}
-for fname in glob.glob('../cluster_scripts/travel_data/*xls'):
-    print(f"Loading {fname}")
-    country = fname.split('/')[-1][:-4]
-    if country=='UK':
-        country = 'United Kingdom'
-    else:
-        country = country[0].upper() + country[1:]
-
-    d = pd.read_excel(fname, skiprows=2).astype(str)
-    travel_volume[country] = d.iloc[0,3:].apply(lambda x:int(x.replace('.','')))
-    travel_volume[country].index = [datetime.datetime(2020,i,15) for i in range(1,11)]
-
-d = pd.read_excel('../cluster_scripts/travel_data/UK.xls', skiprows=2).astype(str)
-travel_volume["Wales"] = d.iloc[0,3:].apply(lambda x:int(int(x.replace('.','')) * popsizes['Wales']/popsizes['United Kingdom']))
-travel_volume["Wales"].index = [datetime.datetime(2020,i,15) for i in range(1,11)]
+_travel_volume = None
+
+
+def load_travel_volume():
+    # monthly departures from Spain per country; read from the Excel files on first use
+    global _travel_volume
+    if _travel_volume is not None:
+        return _travel_volume
+
+    travel_volume = {}
+    for fname in glob.glob('../cluster_scripts/travel_data/*xls'):
+        print(f"Loading {fname}")
+        country = fname.split('/')[-1][:-4]
+        if country=='UK':
+            country = 'United Kingdom'
+        else:
+            country = country[0].upper() + country[1:]
+
+        d = pd.read_excel(fname, skiprows=2).astype(str)
+        travel_volume[country] = d.iloc[0,3:].apply(lambda x:int(x.replace('.','')))
+        travel_volume[country].index = [datetime.datetime(2020,i,15) for i in range(1,11)]
+
+    d = pd.read_excel('../cluster_scripts/travel_data/UK.xls', skiprows=2).astype(str)
+    travel_volume["Wales"] = d.iloc[0,3:].apply(lambda x:int(int(x.replace('.','')) * popsizes['Wales']/popsizes['United Kingdom']))
+    travel_volume["Wales"].index = [datetime.datetime(2020,i,15) for i in range(1,11)]
+    _travel_volume = travel_volume
+    return travel_volume
+
+
 # fake end date to make it easy to update to 'today'
 fake_end_date = "2020-11-01"
 
@@ -3,45 +3,82 @@ import matplotlib.pyplot as plt
 from travel_data import *
 from colors_and_countries import *
 from helpers import *
+from cache import array_hash, cached_arrays
 
 figure_path = '../cluster_scripts/figures/'
 
 
-def get_import_frequency(country, cases, frequency, weeks=None, avg_cases_per_intro=1):
+def import_model_inputs(countries, cases, frequency, weeks=None, source="Spain"):
+    """
+    Aligns everything the import model needs into arrays over countries x weeks:
+    incidence (with the week before the first as column 0), travel rate from `source`
+    per resident and week, and the source's incidence and cluster frequency per week.
+    Weeks without a cluster frequency use 0 before July and the summer average after.
+    """
     if weeks is None:
         weeks = list(range(15,44))
 
-    summer_average = np.mean([x for d,x in frequency.items() if d.month>7])
-    imported_incidence = []
-    import_totals = [0]
-    totals = [0]
-    introductions = []
-    dates = []
-    Re_traj = [1]
-    for week in weeks:
-        d = datetime.datetime.strptime(f"2020-W{week}-1", '%G-W%V-%u')
-        prev_week = datetime.datetime.strptime(f"2020-W{week-1}-1", '%G-W%V-%u')
-        mid_month = datetime.datetime.strptime(f"2020-{d.month:02d}-15", "%Y-%m-%d")
-        dates.append(d)
-
-        # numbers are per month. Hence divide by 30 and multiply by 7 to obtain rates per week\.
-        travel_rate = travel_volume[country][mid_month]/popsizes[country]/30*7
+    dates = [datetime.datetime.fromisocalendar(2020, week, 1) for week in weeks]
+    prev_dates = [datetime.datetime.fromisocalendar(2020, weeks[0]-1, 1)] + dates
+    mid_months = [datetime.datetime(2020, d.month, 15) for d in dates]
 
-        imported_incidence.append(avg_cases_per_intro*cases["Spain"][d]/popsizes["Spain"]*travel_rate*frequency.get(d, 0 if d.month<7 else summer_average))
+    travel_volume = load_travel_volume()
+    pop = np.array([popsizes[c] for c in countries], dtype=float)
+    incidence = np.array([[cases[c].get(d, np.nan) for d in prev_dates] for c in countries], dtype=float)/pop[:,None]
+    # numbers are per month. Hence divide by 30 and multiply by 7 to obtain rates per week.
+    travel_rate = np.array([travel_volume[c].reindex(mid_months).values for c in countries], dtype=float)/pop[:,None]/30*7
 
-        # rate of change not due to imports
-        Re = (cases[country][d]/popsizes[country] - imported_incidence[-1])/(cases[country][prev_week]/popsizes[country])
-
-        Re_traj.append(Re)
-
-        introductions.append(imported_incidence[-1]*popsizes[country]/avg_cases_per_intro)
-        import_totals.append(import_totals[-1]*Re + imported_incidence[-1])
-        totals.append(cases[country][d]/popsizes[country])
+    summer_average = np.mean([x for d,x in frequency.items() if d.month>7])
+    source_frequency = np.array([frequency.get(d, 0 if d.month<7 else summer_average) for d in dates], dtype=float)
+    source_incidence = np.array([cases[source][d] for d in dates], dtype=float)/popsizes[source]
+
+    return {"dates": dates, "countries": list(countries), "popsizes": pop, "incidence": incidence,
+            "travel_rate": travel_rate, "source_incidence": source_incidence, "source_frequency": source_frequency}
+
+
+def import_model(inputs, avg_cases_per_intro=1):
+    """
+    Import model for all countries at once, and for every value of `avg_cases_per_intro`
+    (a number or an array, e.g. a grid to sweep). Returns arrays of shape
+    avg_cases_per_intro x countries x weeks (without the first axis for a single number).
+    """
+    avg = np.asarray(avg_cases_per_intro, dtype=float)
+    a = avg.reshape(-1, 1, 1)
+    incidence = inputs["incidence"]
+
+    imported_incidence = a*inputs["source_incidence"]*inputs["travel_rate"]*inputs["source_frequency"]
+    # rate of change not due to imports
+    Re = (incidence[:,1:] - imported_incidence)/incidence[:,:-1]
+    introductions = imported_incidence*inputs["popsizes"][:,None]/a
+
+    # imports so far keep spreading with Re; only this recursion has to go week by week
+    import_totals = np.zeros_like(imported_incidence)
+    previous = np.zeros(imported_incidence.shape[:2])
+    for i in range(imported_incidence.shape[-1]):
+        previous = previous*Re[...,i] + imported_incidence[...,i]
+        import_totals[...,i] = previous
+
+    res = {"frequency": import_totals/incidence[:,1:], "Re": Re, "introductions": introductions}
+    if avg.ndim == 0:
+        res = {k: v[0] for k, v in res.items()}
+    return res
+
+
+def import_model_sweep(inputs, avg_cases_per_intro):
+    """
+    `import_model` over a grid of `avg_cases_per_intro`, cached on disk by a hash of the inputs.
+    """
+    avg = np.asarray(avg_cases_per_intro, dtype=float)
+    arrays = [inputs[k] for k in ["popsizes", "incidence", "travel_rate", "source_incidence", "source_frequency"]]
+    key = array_hash(*arrays, avg, countries=inputs["countries"], dates=inputs["dates"])
+    return cached_arrays("import_model", key, lambda: import_model(inputs, avg))
 
-    import_totals = np.array(import_totals)[1:]
-    totals = np.array(totals)[1:]
 
-    return {"frequency":import_totals/totals, "dates":dates, "Re": Re_traj, "introductions":introductions}
+def get_import_frequency(country, cases, frequency, weeks=None, avg_cases_per_intro=1):
+    inputs = import_model_inputs([country], cases, frequency, weeks)
+    res = import_model(inputs, avg_cases_per_intro)
+    return {"frequency": res["frequency"][0], "dates": inputs["dates"], "Re": [1] + list(res["Re"][0]),
+            "introductions": list(res["introductions"][0])}
 
 # Need to run `clusterDynamics.py` on 'S222' before doing this
 # (can now run without printing files)
@@ -54,6 +91,7 @@ fs=12
 fmt = 'pdf'
 countries = ["Switzerland", "Spain", "United Kingdom", "Netherlands", "France", "Ireland", "Denmark", "Scotland", "Wales", "Belgium"]
 
+travel_volume = load_travel_volume()
 fig, axs = plt.subplots(2,1, figsize=(6,7), sharex=True)
 for country in countries:
     if country=='Spain':
@@ -70,12 +108,15 @@ fig.autofmt_xdate(rotation=30)
 case_data = load_case_data(countries)
 # fig = plt.figure()
 
-for country in case_data:
-    if country=='Spain':
-        continue
-    res = get_import_frequency(country, case_data, spain_frequency)
-    print(f"{country} -- total imports: {np.sum(res['introductions'])}")
-    axs[1].plot(res['dates'], res['frequency'], label=country, c=country_styles[country]['c'], ls=country_styles[country].get('ls', '-'))
+# all countries at once
+import_countries = [country for country in case_data if country!='Spain']
+import_inputs = import_model_inputs(import_countries, case_data, spain_frequency)
+import_res = import_model(import_inputs)
+import_dates = import_inputs['dates']
+
+for i, country in enumerate(import_countries):
+    print(f"{country} -- total imports: {np.sum(import_res['introductions'][i])}")
+    axs[1].plot(import_dates, import_res['frequency'][i], label=country, c=country_styles[country]['c'], ls=country_styles[country].get('ls', '-'))
 
 axs[1].legend(fontsize=fs*0.9)
 axs[1].tick_params(labelsize=fs*0.8)
@@ -86,6 +127,13 @@ axs[0].text(axs[0].get_xlim()[0]-30, axs[0].get_ylim()[1]+2000, "A", size=22, we
 axs[1].text(axs[1].get_xlim()[0]-30, axs[1].get_ylim()[1]+0.001, "B", size=22, weight="bold")
 plt.savefig(figure_path+f'import_model.{fmt}')
 
+# How the modelled import frequency depends on the number of cases per introduction
+avg_cases_grid = np.array([0.25, 0.5, 1, 2, 4])
+sweep = import_model_sweep(import_inputs, avg_cases_grid)
+for i, country in enumerate(import_countries):
+    mean_freq = np.nanmean(sweep['frequency'][:, i], axis=-1)
+    print(f"{country} -- mean import frequency for {avg_cases_grid} cases per intro: {np.round(mean_freq, 3)}")
+
 
 
 
@@ -105,9 +153,9 @@ for country in countries:
     if country=="Spain":
         continue
 
-    res = get_import_frequency(country, case_data,spain_frequency)
-    scale_factor = np.mean([cluster_freq[i] for i,d in enumerate(week_as_date) if d in res['dates']])/np.mean(res["frequency"])
-    plt.plot(res["dates"], res["frequency"]*scale_factor,
+    import_freq = import_res['frequency'][import_countries.index(country)]
+    scale_factor = np.mean([cluster_freq[i] for i,d in enumerate(week_as_date) if d in import_dates])/np.mean(import_freq)
+    plt.plot(import_dates, import_freq*scale_factor,
             c=country_styles[country]['c'], ls=country_styles[country]['ls'],
             label = f"{country}, scale: {scale_factor:1.2f}")
 
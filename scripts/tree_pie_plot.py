@@ -20,10 +20,13 @@ import treetime
 from collections import Counter
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+from matplotlib.collections import PolyCollection
+from matplotlib.transforms import IdentityTransform
 import numpy as np
 import math
 import datetime
-from shutil import copyfile
+from artifact_store import record
+from plot_helpers import savefig
 from collections import defaultdict
 import copy
 import pandas as pd
@@ -209,18 +212,30 @@ for n in cluster2.get_nonterminals(order='preorder'):
         c.x = n.x + c.branch_length
 
 # Function to draw pie charts
-def draw_pie(ax, ratios=[0.4,0.3,0.3], colors=["red", "blue"], X=0, Y=0, size = 1000):
-    N = len(ratios)
-    xy = []
-    start = 0.
-    for ratio in ratios:
-        x = [0] + np.cos(np.linspace(2*math.pi*start,2*math.pi*(start+ratio), 30)).tolist()
-        y = [0] + np.sin(np.linspace(2*math.pi*start,2*math.pi*(start+ratio), 30)).tolist()
-        xy1 = list(zip(x,y))
-        xy.append(xy1)
-        start += ratio
-    for i, xyi in enumerate(xy):
-        ax.scatter([X],[Y] , marker=xyi, s=size, facecolor=colors[i] )
+def draw_pies(ax, ratios, colors, X, Y, sizes, n_points=30):
+    # All pies at once, as a single collection with one wedge polygon per (node, country).
+    # `ratios` and `colors` hold one list per pie, `X`, `Y` and `sizes` one value per pie.
+    # Looks the same as a scatter per wedge with the wedge as custom marker: like a marker,
+    # each wedge is scaled to 0.5/max|vertex| and `sizes` are marker areas in points^2.
+    n_wedges = [len(r) for r in ratios]
+    ratios = np.concatenate([np.asarray(r, dtype=float) for r in ratios])
+    ends = np.concatenate([np.cumsum(r) for r in np.split(ratios, np.cumsum(n_wedges)[:-1])])
+    starts = ends - ratios
+
+    angles = 2*math.pi*(starts[:,None] + ratios[:,None]*np.linspace(0, 1, n_points))
+    verts = np.zeros((len(ratios), n_points+1, 2))
+    verts[:,1:,0] = np.cos(angles)
+    verts[:,1:,1] = np.sin(angles)
+    verts *= 0.5/np.abs(verts).max(axis=(1,2))[:,None,None]
+
+    pies = PolyCollection(verts, closed=False, sizes=np.repeat(sizes, n_wedges),
+                          offsets=np.repeat(np.column_stack([X, Y]), n_wedges, axis=0), offset_transform=ax.transData,
+                          facecolors=[c for cols in colors for c in cols], edgecolors='face',
+                          linewidths=plt.rcParams['lines.linewidth'])
+    pies.set_transform(IdentityTransform())
+    ax.add_collection(pies)
+    ax.autoscale_view()
+    return pies
 
 # Give each node a character name to make the easier to discuss/identify
 # Also store country counts for each node by this name (so can associate
@@ -295,19 +310,23 @@ def list_parent_countries(wanted_country, second_country):
 fs = 16
 fig = plt.figure(figsize=(12,18))
 ax = fig.add_subplot(1,1,1)
-Phylo.draw(cluster2, label_func=lambda x:'', axes=ax),
-           branch_labels=lambda x: ",".join([f"{a}{p+1}{d}" for a,p,d in x.mutations]))
+Phylo.draw(cluster2, label_func=lambda x:'', axes=ax)
+#           branch_labels=lambda x: ",".join([f"{a}{p+1}{d}" for a,p,d in x.mutations]))
 
+pie_ratios, pie_colors, pie_x, pie_y, pie_sizes = [], [], [], [], []
 for node in cluster2.find_clades(order="preorder"):
     counts = node_counts[node.name].to_dict()
     sqrt_counts = np.array([x for k,x in counts.items() if x>0])**0.25
     total_counts = sum(list(counts.values()))
     nonzero = [k for k,x in counts.items() if x>0]
-    draw_pie(ax=plt.gca(), ratios=[x/sqrt_counts.sum() for x in sqrt_counts],
-        colors=[country_styles[c]['c'] for c in nonzero], X=node.x, Y=node.y,
-        size=200*np.sum(total_counts)**0.25)
+    pie_ratios.append([x/sqrt_counts.sum() for x in sqrt_counts])
+    pie_colors.append([country_styles[c]['c'] for c in nonzero])
+    pie_x.append(node.x)
+    pie_y.append(node.y)
+    pie_sizes.append(200*np.sum(total_counts)**0.25)
     # plt.text(node.x+0.00001, node.y, int(sum(list(counts.values()))))
     # plt.text(node.x-0.000015, node.y, node_names[node.name] )
+draw_pies(ax, pie_ratios, pie_colors, pie_x, pie_y, pie_sizes)
 
 for ni,n in enumerate([1,10,100]):
     ax.scatter([0.00002*(ni+1)], [2], s=200*np.sum(n)**0.25, edgecolor='k', facecolor='w')
@@ -322,9 +341,9 @@ if not uk_run:
 else:
     tree_path = figure_path+f"uk_pie_tree.{fmt}"
 
-plt.savefig(tree_path)
+savefig(plt.gcf(), tree_path)
 copypath = tree_path.replace("tree", "tree-{}".format(datetime.date.today().strftime("%Y-%m-%d")))
-copyfile(tree_path, copypath)
+record(tree_path, copypath)
 
 
 
@@ -0,0 +1,173 @@
+"""
+Overall trends figures: the frequency of a cluster per country over time.
+
+The main script prepares one picklable job per figure (`trend_job`, with the series
+from `trend_series`), and `render_trend_figure` draws and saves it, so the figures
+can be rendered in worker processes (see render_pool.py). Figures are drawn from a
+template per layout that is only built once per process. matplotlib is only imported
+once a figure is drawn, so preparing the jobs (and the data they hold) doesn't need it.
+"""
+
+import datetime
+
+import numpy as np
+
+from cache import content_hash
+from plot_helpers import fs, marker_size, savefig
+
+
+def trend_series(coun, week_as_date, cluster_count, total_count, unsmoothed_total_count, style, uncertain=None):
+    # one country's line and markers; `uncertain` marks weeks drawn with open markers
+    return {
+        'country': coun,
+        'dates': list(week_as_date),
+        'frequency': np.divide(cluster_count, total_count, out=np.full(len(total_count), np.nan),
+                               where=np.asarray(total_count) > 0),
+        'sizes': [marker_size(n) for n in unsmoothed_total_count],
+        'color': style['c'],
+        'ls': style['ls'],
+        'uncertain': np.zeros(len(week_as_date), dtype=bool) if uncertain is None else np.asarray(uncertain, dtype=bool),
+    }
+
+
+def trend_job(fname, clus_display, series, key_dates, max_date, travel=None, spain_opens=False):
+    """
+    Everything drawn in one overall trends figure. `key_dates` are the first two weeks
+    of the data (where the marker size key goes), `max_date` the last sequence date
+    ('YYYY-MM-DD'). `travel` is an optional quarantine-free travel panel:
+    {'order': [...], 'q_free': {...}, 'colors': {country: color}}.
+    """
+    return {'fname': fname, 'clus_display': clus_display, 'series': series, 'key_dates': list(key_dates),
+            'max_date': max_date, 'travel': travel, 'spain_opens': spain_opens}
+
+
+def draw_travel_panel(ax1, travel):
+    from matplotlib.patches import Rectangle
+
+    i=0
+    for coun in travel['order']:
+        if coun in travel['q_free']:
+            q_times = travel['q_free'][coun]
+            strt = datetime.datetime.strptime(q_times["start"], "%Y-%m-%d")
+            end = datetime.datetime.strptime(q_times["end"], "%Y-%m-%d")
+            y_start = i*0.022
+            height = 0.02
+            ax1.add_patch(Rectangle((strt,y_start), end-strt, height,
+                        ec=travel['colors'][coun], fc=travel['colors'][coun]))
+
+            ax1.text(strt, y_start+0.003, q_times["msg"], fontsize=fs*0.8)
+            if coun == "Denmark":
+                strt = datetime.datetime.strptime(travel['q_free']["Denmark2"]["start"], "%Y-%m-%d")
+                end = datetime.datetime.strptime(travel['q_free']["Denmark2"]["end"], "%Y-%m-%d")
+                ax1.add_patch(Rectangle((strt,y_start), end-strt, height,
+                        ec=travel['colors'][coun], fc="none", hatch="/"))
+                ax1.text(strt, y_start+0.003, travel['q_free']["Denmark2"]["msg"], fontsize=fs*0.8)
+        i=i+1
+    ax1.set_ylim([0,y_start+height])
+    ax1.text(datetime.datetime.strptime("2020-05-03", "%Y-%m-%d"), y_start,
+            "Quarantine-free", fontsize=fs)
+    ax1.text(datetime.datetime.strptime("2020-05-03", "%Y-%m-%d"), y_start-height-0.005,
+            "Travel to/from Spain", fontsize=fs)
+    ax1.text(datetime.datetime.strptime("2020-05-03", "%Y-%m-%d"), y_start-height-height-0.01,
+            "(on return)", fontsize=fs)
+    ax1.get_yaxis().set_visible(False)
+
+
+class TrendTemplate:
+    """
+    An overall trends figure with its axes and static artists built once; `render`
+    swaps in a job's data. Line and marker artists are kept in slots, one per
+    country, and unused slots are hidden.
+    """
+
+    def __init__(self, travel=None):
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+
+        if travel:
+            self.fig, (ax1, ax3) = plt.subplots(nrows=2, sharex=True,figsize=(10,6),
+                                                gridspec_kw={'height_ratios':[1, 3]})
+            draw_travel_panel(ax1, travel)
+        else:
+            self.fig, ax3 = plt.subplots(1, 1, figsize=(10,5),dpi=72)
+        self.ax = ax3
+        ax3.xaxis_date()
+        self.slots = []
+        self.legend = None
+
+        self.key = [ax3.scatter([0], [0.08+ni*0.07], s=marker_size(n+0.1), edgecolor='k', facecolor='w')
+                    for ni,n in enumerate([0,1,3,10,30,100])]
+        self.key_labels = [ax3.text(0, 0.06+ni*0.07, f"n>{n}" if n else "n=1")
+                           for ni,n in enumerate([0,1,3,10,30,100])]
+        self.title = ax3.text(mdates.date2num(datetime.datetime(2020,10,1)), 0.9, '', fontsize=fs)
+        ax3.tick_params(labelsize=fs*0.8)
+        ax3.set_ylabel('frequency', fontsize=fs)
+        ax3.set_ylim(0,1)
+        self.spain_opens = ax3.text(mdates.date2num(datetime.datetime(2020,6,21)), 0.05,
+                "Spain opens borders", rotation='vertical', fontsize=fs*0.8, visible=False)
+
+    def add_slots(self, n):
+        ax3 = self.ax
+        while len(self.slots) < n:
+            line, = ax3.plot([], [])
+            self.slots.append((line, ax3.scatter([], []), ax3.scatter([], [], facecolor='w')))
+        # keep the marker size key drawn on top of the data markers
+        for key in self.key:
+            key.remove()
+            ax3.add_collection(key, autolim=False)
+
+    def render(self, job):
+        import matplotlib.dates as mdates
+
+        ax3 = self.ax
+        self.add_slots(len(job['series']))
+        for i, (line, markers, open_markers) in enumerate(self.slots):
+            used = i < len(job['series'])
+            for artist in (line, markers, open_markers):
+                artist.set_visible(used)
+            if not used:
+                continue
+
+            s = job['series'][i]
+            x = mdates.date2num(s['dates'])
+            line.set_data(x, s['frequency'])
+            line.set_color(s['color'])
+            line.set_linestyle(s['ls'])
+            line.set_label(s['country'])
+            markers.set_offsets(np.column_stack([x, s['frequency']]))
+            markers.set_sizes(s['sizes'])
+            markers.set_color(s['color'])
+            markers.set_linestyle(s['ls'])
+            open_markers.set_offsets(np.column_stack([x, s['frequency']])[s['uncertain']])
+            open_markers.set_sizes(np.array(s['sizes'])[s['uncertain']])
+            open_markers.set_edgecolor(s['color'])
+
+        key_x = mdates.date2num(job['key_dates'])
+        for ni, (key, label) in enumerate(zip(self.key, self.key_labels)):
+            key.set_offsets([[key_x[0], 0.08+ni*0.07]])
+            label.set_x(key_x[1])
+        self.title.set_text(job['clus_display'])
+
+        if self.legend is not None:
+            self.legend.remove()
+        self.legend = ax3.legend(handles=[line for line, _, _ in self.slots[:len(job['series'])]],
+                                 ncol=1, fontsize=fs*0.8, loc=2)
+        ax3.set_xlim(datetime.datetime(2020,5,1), datetime.datetime.strptime(job['max_date'], "%Y-%m-%d"))
+        self.fig.autofmt_xdate(rotation=30)
+        self.spain_opens.set_visible(False)
+        self.fig.tight_layout()
+        self.spain_opens.set_visible(job['spain_opens'])
+
+        savefig(self.fig, job['fname'])
+        return job['fname']
+
+
+# one template per layout, kept for the life of the (worker) process
+_templates = {}
+
+
+def render_trend_figure(job):
+    layout = content_hash(job['travel'])
+    if layout not in _templates:
+        _templates[layout] = TrendTemplate(job['travel'])
+    return _templates[layout].render(job)
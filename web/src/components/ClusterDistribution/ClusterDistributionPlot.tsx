@@ -21,6 +21,12 @@ export interface ClusterDistributionDatum {
   frequencies: {
     [country: string]: number | undefined
   }
+  frequencies_lower?: {
+    [country: string]: number | undefined
+  }
+  frequencies_upper?: {
+    [country: string]: number | undefined
+  }
   interp: {
     [country: string]: boolean | undefined
   }